@@ -6,9 +6,10 @@ Generate 256-color definition for Vim's colorscheme
 http://www.vim.org/scripts/script.php?script_id=2778
 '''
 
-__version__ = 3.04
+__version__ = 3.05
 
 import os, sys, re, io
+import json
 from math import sqrt, exp, sin, radians, degrees, atan2, fabs, cos
 import warnings
 
@@ -264,67 +265,177 @@ re_hiline = re.compile(r'^\s*hi\w*\s+(?!link\b)[A-Z]\w+')
 # others {{{2
 name2rgb = {}
 Normal = None
+# where the parsed rgb.txt is cached
+rgbcache = os.path.join(
+  os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+  'gui2term-rgb.json')
+# common locations of rgb.txt, tried before running locate
+rgbpaths = ('/usr/share/X11/rgb.txt', '/etc/X11/rgb.txt',
+            '/usr/lib/X11/rgb.txt')
 
 # Functions {{{1
-def getRgbtxt(): # {{{2
+def localRgbtxt(): # {{{2
+  '''rgb.txt in the current directory or beside the script, if any'''
   scriptdir = os.path.dirname(os.path.abspath(sys.argv[0]))
   if os.path.isfile('rgb.txt'):
-    rgbfile = 'rgb.txt'
+    return os.path.abspath('rgb.txt')
   elif os.path.isfile(os.path.join(scriptdir, 'rgb.txt')):
-    rgbfile = os.path.join(scriptdir, 'rgb.txt')
+    return os.path.join(scriptdir, 'rgb.txt')
+  return None
+
+def getRgbtxt(cached=None): # {{{2
+  '''find rgb.txt; cached is the path recorded in the cache, which is
+  preferred to running locate but not to a local rgb.txt'''
+  rgbfile = localRgbtxt()
+  if rgbfile:
+    pass
+  elif cached and os.path.isfile(cached):
+    rgbfile = cached
   else:
-    try:
-      import subprocess
-      rgbfile = io.StringIO(subprocess.check_output(['locate', '-b', '--regex', '-e', r'^rgb\.txt$']).decode()).readline().strip()
-    except:
-      warnings.warn("rgb.txt not found, color names will cause errors", Warning)
-      rgbfile = None
+    for rgbfile in rgbpaths:
+      if os.path.isfile(rgbfile):
+        break
+    else:
+      try:
+        import subprocess
+        rgbfile = io.StringIO(subprocess.check_output(['locate', '-b', '--regex', '-e', r'^rgb\.txt$']).decode()).readline().strip()
+      except:
+        rgbfile = None
+      if not rgbfile:
+        warnings.warn("rgb.txt not found, color names will cause errors", Warning)
+        rgbfile = None
   return rgbfile
 
 def color_norm(c): # {{{2
   return tuple(int(x, 16)/255.0 for x in (c[1:3], c[3:5], c[5:7]))
 
-def loadRgb(): # {{{2
-  rgbfile = getRgbtxt()
-  if rgbfile is None:
-    return
-  try:
-    for l in open(rgbfile):
+def parseRgb(rgbfile): # {{{2
+  ret = {}
+  with open(rgbfile) as f:
+    for l in f:
       if not l.startswith('!'):
         r, g, b, name = l.split(None, 3)
         name = name.strip().lower()
         if ' ' in name:
           name = "'%s'" % name
-        name2rgb[name] = int(r), int(g), int(b)
+        ret[name] = int(r), int(g), int(b)
+  return ret
+
+def loadRgb(): # {{{2
+  '''fill name2rgb, from the cache if rgb.txt hasn't changed since
+
+  A local rgb.txt (see localRgbtxt) is always parsed and never cached,
+  as it's only meant for the current directory.'''
+  local = localRgbtxt()
+  if local:
+    try:
+      name2rgb.update(parseRgb(local))
+    except IOError:
+      print('Failed to open rgb file', local, file=sys.stderr)
+    return
+
+  try:
+    with open(rgbcache) as f:
+      cache = json.load(f)
+  except (IOError, ValueError):
+    cache = {}
+
+  rgbfile = getRgbtxt(cache.get('file'))
+  if rgbfile is None:
+    return
+  try:
+    mtime = os.stat(rgbfile).st_mtime_ns
+    if cache.get('file') == rgbfile and cache.get('mtime') == mtime:
+      name2rgb.update((k, tuple(v)) for k, v in cache['colors'].items())
+      return
+    name2rgb.update(parseRgb(rgbfile))
   except IOError:
     print('Failed to open rgb file', rgbfile, file=sys.stderr)
+    return
+
+  try:
+    os.makedirs(os.path.dirname(rgbcache), exist_ok=True)
+    tmp = '%s.%d.tmp' % (rgbcache, os.getpid())
+    with open(tmp, 'w') as f:
+      json.dump({'file': rgbfile, 'mtime': mtime, 'colors': name2rgb}, f)
+    os.replace(tmp, rgbcache)
+  except IOError:
+    pass
 
 def convert(infile, outfile): # {{{2
   global Normal
 
-  infile = open(infile)
-  for l in infile:
+  Normal = None
+  with open(infile) as f:
+    lines = f.readlines()
+  for l in lines:
     if l.lower().find('normal') != -1:
       Normal = Group(l)
-      infile.seek(0)
       break
 
-  outfile = open(outfile, 'w')
-  for l in infile:
+  out = []
+  for l in lines:
     if re_hiline.match(l):
-      outfile.write(str(Group(l)))
+      out.append(str(Group(l)))
     else:
-      outfile.write(l)
+      out.append(l)
+
+  # so that a failed conversion doesn't leave a partial file
+  tmp = '%s.%d.tmp' % (outfile, os.getpid())
+  try:
+    with open(tmp, 'w') as f:
+      f.writelines(out)
+    os.replace(tmp, outfile)
+  except BaseException:
+    try:
+      os.unlink(tmp)
+    except OSError:
+      pass
+    raise
+
+def _init_worker(colors): # {{{2
+  name2rgb.update(colors)
+
+def _convert_one(infile, outfile): # {{{2
+  try:
+    convert(infile, outfile)
+  except Exception as e:
+    return '%s: %r' % (infile, e)
+
+def convert_dir(srcdir, destdir, jobs=None): # {{{2
+  '''convert all *.vim files in srcdir to destdir, in parallel processes
+
+  return a list of error messages'''
+  from concurrent.futures import ProcessPoolExecutor
+
+  os.makedirs(destdir, exist_ok=True)
+  names = sorted(x for x in os.listdir(srcdir) if x.endswith('.vim'))
+  with ProcessPoolExecutor(
+    jobs, initializer=_init_worker, initargs=(name2rgb,),
+  ) as pool:
+    errors = pool.map(
+      _convert_one,
+      [os.path.join(srcdir, x) for x in names],
+      [os.path.join(destdir, x) for x in names],
+      chunksize=4,
+    )
+    return [e for e in errors if e]
 
 def delta_e_cie2000(color1, color2): # {{{2
   """
   Calculates the Delta E (CIE2000) of two colors.
+  """
+  return delta_e_lab(color1.tolab(), color2.tolab())
+
+def delta_e_lab(lab1, lab2): # {{{2
+  """
+  Calculates the Delta E (CIE2000) of two colors in LAB.
 
   Stolen from colormath.color_objects
   """
   Kl = Kc = Kh = 1
-  L1, a1, b1 = color1.tolab()
-  L2, a2, b2 = color2.tolab()
+  L1, a1, b1 = lab1
+  L2, a2, b2 = lab2
 
   avg_Lp = (L1 + L2) / 2.0
   C1 = sqrt(pow(a1, 2) + pow(b1, 2))
@@ -397,16 +508,23 @@ class color: # {{{2
   @property
   def termcolor(self): # {{{3
     '''selects the nearest xterm color for a rgb value ('color' class)'''
+    try:
+      return _termcolor_cache[self.value]
+    except KeyError:
+      pass
+
     best_match = 0
     smallest_distance = 10000000
+    lab = self.tolab()
 
-    for c in range(16, 256):
-      d = delta_e_cie2000(color(termcolor[c]), self)
+    for c, palette in _palette_lab:
+      d = delta_e_lab(palette, lab)
 
       if d < smallest_distance:
         smallest_distance = d
         best_match = c
 
+    _termcolor_cache[self.value] = best_match
     return best_match
 
   def tolab(self):
@@ -462,6 +580,10 @@ class color: # {{{2
 
     return L, a, b
 
+# LAB values of the palette, and the best matches found so far
+_palette_lab = [(c, color(termcolor[c]).tolab()) for c in range(16, 256)]
+_termcolor_cache = {}
+
 class Group: # {{{2
   def __init__(self, line): # {{{3
     words = tuple(highlight_word.finditer(line))
@@ -546,15 +668,28 @@ def test(): # {{{1
 if __name__ == '__main__': # {{{1
   # test()
   # sys.exit()
-  if len(sys.argv) == 3:
+  args = sys.argv[1:]
+  jobs = None
+  if len(args) == 4 and args[0] == '-j':
+    jobs = int(args[1])
+    args = args[2:]
+  if len(args) == 2:
     loadRgb()
     try:
-      convert(sys.argv[1], sys.argv[2])
+      if os.path.isdir(args[0]):
+        errors = convert_dir(args[0], args[1], jobs)
+        for e in errors:
+          print(e, file=sys.stderr)
+        if errors:
+          sys.exit(2)
+      else:
+        convert(args[0], args[1])
     except IOError:
       print('Error opening file', file=sys.stderr)
       sys.exit(2)
   else:
     print('Usage: gui2term.py SRC_FILE DEST_FILE')
+    print('       gui2term.py [-j JOBS] SRC_DIR DEST_DIR')
     sys.exit(1)
 
 # vim:se fdm=marker:
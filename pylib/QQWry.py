@@ -10,7 +10,9 @@ lilydjwg 再次修改于 2019-01-02
 本程序遵循 GNU GENERAL PUBLIC LICENSE Version 2 (http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt)
 '''
 
-from struct import unpack, pack
+from struct import unpack, pack, iter_unpack
+from array import array
+from bisect import bisect_right
 import sys
 import socket, mmap
 from collections import namedtuple
@@ -20,7 +22,8 @@ import zlib
 import subprocess
 import tempfile
 import shutil
-from typing import Tuple
+from functools import lru_cache
+from typing import Tuple, List, Optional, Iterable, Union
 
 from myutils import safe_overwrite
 
@@ -56,13 +59,17 @@ class IpInfo(namedtuple('IpInfo', 'sip eip country area')):
       _ulong2ip(self[0]), _ulong2ip(self[1]), self[2], self[3])
 
 class QQWry:
-  def __init__(self, dbfile=DataFileName, charset='gbk'):
+  def __init__(self, dbfile=DataFileName, charset='gbk', cache_size=8192):
+    '''cache_size 为按偏移缓存的已解码记录与字符串的最大条数, None 表示不限.'''
     self.charset = charset
+    self._readRec = lru_cache(cache_size)(self._readRec)
+    self._read_cstring = lru_cache(cache_size)(self._read_cstring)
     with open(dbfile, 'rb') as dbfile:
       self.f = mmap.mmap(dbfile.fileno(), 0, access=mmap.MAP_SHARED)
     self.indexBaseOffset = unpack('<L', self.f[0:4])[0] #索引区基址
     self.count = (unpack('<L', self.f[4:8])[0]
                   - self.indexBaseOffset) // 7 # 索引数-1
+    self._index_ips: Optional[array] = None
 
   def Lookup(self, ip: str) -> IpInfo:
     '''x.Lookup(ip) -> (sip, eip, country, area) 查找 ip 所对应的位置.
@@ -97,6 +104,47 @@ class QQWry:
     else:
       return ipinfo
 
+  def _load_index(self) -> array:
+    '''一次性读出索引区所有起始 ip, 供批量查询使用.'''
+    if self._index_ips is None:
+      start = self.indexBaseOffset
+      end = start + 7 * (self.count + 1)
+      ips = array('L')
+      ips.extend(ip for ip, _ in iter_unpack('<L3s', self.f[start:end]))
+      self._index_ips = ips
+    return self._index_ips
+
+  def lookup_many(
+    self, ips: Iterable[Union[str, int]],
+  ) -> List[Optional[IpInfo]]:
+    '''x.lookup_many(ips) -> [IpInfo 或 None, ...] 批量查找.
+
+    ips 可以是点分十进制字符串或 unsigned long 型 ip 地址.
+    先把整批 ip 排序, 再在预读的索引数组上顺序二分查找,
+    结果按输入顺序返回, 找不到的 ip 对应 None.
+    返回的 IpInfo 与 x._n_lookup(ip) 一样, 其中的 ip 是整数.
+    '''
+    needles = [_ip2ulong(ip) if isinstance(ip, str) else ip for ip in ips]
+    index_ips = self._load_index()
+    order = sorted(range(len(needles)), key=needles.__getitem__)
+
+    results: List[Optional[IpInfo]] = [None] * len(needles)
+    lo = 0
+    last_i = -1
+    info = None
+    for n in order:
+      ip = needles[n]
+      i = bisect_right(index_ips, ip, lo) - 1
+      if i < 0:
+        continue
+      lo = i
+      if i != last_i:
+        info = self[i]
+        last_i = i
+      if ip <= info[1]:
+        results[n] = info
+    return results
+
   def __str__(self):
     tmp = []
     tmp.append('RecCount:')
@@ -151,7 +199,7 @@ class QQWry:
     ip, offset = unpack('<LL', data)
     return ip, offset
 
-  def _readRec(self, pos: int, *, onlyOne=False):
+  def _readRec(self, pos: int, *, onlyOne=False) -> Tuple[str, ...]:
     f = self.f
     mode = f[pos]
     if mode == 0x01:
@@ -161,15 +209,46 @@ class QQWry:
       rp = self._read3ByteOffset(pos+1)
       result = self._readRec(rp, onlyOne=True)
       if not onlyOne:
-        result.append(self._readRec(pos+4, onlyOne=True)[0])
+        result += self._readRec(pos+4, onlyOne=True)
     else: # string
       s, new_pos = self._read_cstring(pos)
-      result = [s]
+      result = (s,)
       if not onlyOne:
-        result.append(self._readRec(new_pos, onlyOne=True)[0])
+        result += self._readRec(new_pos, onlyOne=True)
 
     return result
 
+  def cache_info(self):
+    '''返回记录缓存与字符串缓存的命中统计, 用于调整 cache_size.'''
+    return {
+      'rec': self._readRec.cache_info(),
+      'cstring': self._read_cstring.cache_info(),
+    }
+
+  def cache_clear(self):
+    self._readRec.cache_clear()
+    self._read_cstring.cache_clear()
+
+  def close(self):
+    '''清空缓存并关闭数据文件.
+
+    缓存包装了绑定方法, 与实例构成循环引用, 不调用 close 的话要等到
+    循环垃圾回收时才会释放 mmap.'''
+    if self.f.closed:
+      return
+    self.cache_clear()
+    # 去掉实例上的缓存包装, 打破循环引用
+    self.__dict__.pop('_readRec', None)
+    self.__dict__.pop('_read_cstring', None)
+    self._index_ips = None
+    self.f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
   def getDate(self):
     return _extract_date(self[self.count].area)
 
@@ -238,6 +317,33 @@ def update(q):
   finally:
     shutil.rmtree(tmp_dir)
 
+def _lookup_stream(Q, f, batch_size=10000):
+  def flush(batch):
+    needles = []
+    for ip in batch:
+      try:
+        needles.append(_ip2ulong(ip))
+      except OSError:
+        needles.append(-1)
+    for ip, info in zip(batch, Q.lookup_many(needles)):
+      if info is None:
+        print(ip)
+      else:
+        print(ip, ''.join(info[2:]))
+    sys.stdout.flush()
+
+  batch = []
+  for line in f:
+    ip = line.strip()
+    if not ip:
+      continue
+    batch.append(ip)
+    if len(batch) >= batch_size:
+      flush(batch)
+      batch = []
+  if batch:
+    flush(batch)
+
 def main():
   import argparse
   parser = argparse.ArgumentParser(description='纯真IP数据库查询与更新')
@@ -276,8 +382,8 @@ def main():
   if not ips:
     print(Q)
   elif len(ips) == 1:
-    if ips[0] == '-': #参数只有一个“-”时，从标准输入读取IP
-      print(''.join(Q[input()][2:]))
+    if ips[0] == '-': #参数只有一个“-”时，从标准输入流式读取IP，每行一个
+      _lookup_stream(Q, sys.stdin)
     else: #参数只有一个IP时，只输出简要的信息
       print(' '.join(Q[sys.argv[1]][2:]))
   else:
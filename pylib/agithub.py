@@ -1,16 +1,20 @@
+import os
 import datetime
 import json
 import weakref
 import asyncio
 import logging
 import time
+import hashlib
+from urllib.parse import urljoin, urlsplit, parse_qs, urlencode, urlunsplit
 from typing import (
-  AsyncGenerator, Tuple, Any, Dict, Optional, List, Union, cast,
+  AsyncGenerator, Tuple, Any, Dict, Optional, List, Union, Callable, cast,
 )
 import enum
 
 from httpx import Response
 import httpxutils
+from myutils import safe_overwrite
 
 logger = logging.getLogger(__name__)
 
@@ -27,12 +31,113 @@ class GitHubError(Exception):
     self.documentation = documentation
     self.code = code
 
+_GRAPHQL_ISSUE_FIELDS = '''
+fragment issueFields on Issue {
+  number title body state updatedAt url
+  author { login }
+  labels(first: 100) { nodes { name } }
+  assignees(first: 100) { nodes { login } }
+  comments(first: 100) {
+    pageInfo { hasNextPage endCursor }
+    nodes { databaseId url body author { login } }
+  }
+}
+'''
+
+_GRAPHQL_ISSUES = '''
+query($owner: String!, $name: String!, $states: [IssueState!], $first: Int!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    issues(states: $states, first: $first, after: $after) {
+      pageInfo { hasNextPage endCursor }
+      nodes { ...issueFields }
+    }
+  }
+}
+''' + _GRAPHQL_ISSUE_FIELDS
+
+_GRAPHQL_MORE_COMMENTS = '''
+query($owner: String!, $name: String!, $number: Int!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    issue(number: $number) {
+      comments(first: 100, after: $after) {
+        pageInfo { hasNextPage endCursor }
+        nodes { databaseId url body author { login } }
+      }
+    }
+  }
+}
+'''
+
 class GitHub(httpxutils.ClientBase):
   baseurl = 'https://api.github.com/'
-
-  def __init__(self, token, session=None):
+  graphql_url = '/graphql'
+  # how many pages to fetch at a time when the last page is known
+  page_concurrency = 4
+  # start spreading requests over the rest of the rate limit window
+  # when fewer than this many requests are left
+  ratelimit_reserve = 100
+
+  def __init__(self, token, session=None, rate_limiter=None, cache_dir=None):
     self.token = f'token {token}'
-    super().__init__(session = session)
+    super().__init__(session = session, rate_limiter = rate_limiter)
+    self.cache_dir = cache_dir
+    if cache_dir is not None:
+      os.makedirs(cache_dir, exist_ok=True)
+    self.ratelimit_remaining: Optional[int] = None
+    self.ratelimit_reset = 0.0
+    self._next_slot = 0.0
+
+  def _cache_path(self, url: str, params: Optional[Dict[str, Any]]) -> str:
+    key = '\0'.join([
+      self.token, urljoin(self.baseurl, url),
+      urlencode(sorted((params or {}).items())),
+    ])
+    name = hashlib.sha256(key.encode()).hexdigest()
+    return os.path.join(self.cache_dir, name) # type: ignore
+
+  def _cache_load(self, path: str) -> Optional[JsonDict]:
+    try:
+      with open(path) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def _cache_save(self, path: str, res: Response) -> None:
+    h = res.headers
+    if 'ETag' not in h and 'Last-Modified' not in h:
+      return
+    entry = {
+      'etag': h.get('ETag'),
+      'last_modified': h.get('Last-Modified'),
+      'link': h.get('Link'),
+      'body': res.text,
+    }
+    try:
+      safe_overwrite(path, json.dumps(entry))
+    except OSError:
+      logger.exception('failed to save cache %s', path)
+
+  async def _throttle(self) -> None:
+    '''pace requests so that the rate limit lasts until it resets'''
+    remaining = self.ratelimit_remaining
+    if remaining is None or remaining >= self.ratelimit_reserve:
+      return
+    now = time.time()
+    if now >= self.ratelimit_reset:
+      return
+    interval = (self.ratelimit_reset - now) / max(remaining, 1)
+    slot = max(now, self._next_slot)
+    self._next_slot = slot + interval
+    if slot > now:
+      logger.debug('%d requests left; waiting %.1fs', remaining, slot - now)
+      await asyncio.sleep(slot - now)
+
+  def _update_ratelimit(self, res: Response) -> None:
+    try:
+      self.ratelimit_remaining = int(res.headers['X-RateLimit-Remaining'])
+      self.ratelimit_reset = int(res.headers['X-RateLimit-Reset'])
+    except (KeyError, ValueError):
+      pass
 
   async def api_request(
     self, path: str, method: str = 'get',
@@ -51,10 +156,33 @@ class GitHub(httpxutils.ClientBase):
       h.setdefault('Content-Type', 'application/json')
       kwargs['content'] = binary_data
 
+    cache_path = cached = None
+    if self.cache_dir is not None and method.lower() == 'get':
+      cache_path = self._cache_path(path, kwargs.get('params'))
+      cached = self._cache_load(cache_path)
+      if cached:
+        if cached['etag']:
+          h['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+          h['If-Modified-Since'] = cached['last_modified']
+
     for _ in range(3):
+      await self._throttle()
       res = await self.request(path, method=method, **kwargs)
+      self._update_ratelimit(res)
       j: JsonDict
-      if res.status_code == 204:
+      if res.status_code == 304 and cached:
+        # not modified; this doesn't count against the rate limit
+        headers = {
+          k: v for k, v in res.headers.items()
+          if k not in ('content-encoding', 'content-length', 'transfer-encoding')
+        }
+        if cached['link']:
+          headers['Link'] = cached['link']
+        res = Response(
+          200, headers=headers, text=cached['body'], request=res.request)
+        j = res.json()
+      elif res.status_code == 204:
         j = {}
       else:
         await res.aread()
@@ -66,28 +194,66 @@ class GitHub(httpxutils.ClientBase):
             await asyncio.sleep(reset)
             continue
           raise GitHubError(j['message'], j['documentation_url'], res.status_code)
+        if cache_path is not None and res.status_code == 200:
+          self._cache_save(cache_path, res)
       return j, res
 
     raise Exception('unreachable')
 
-  async def get_repo_issues(
-    self, repo: str, *, state: str = 'open', labels: str = '',
-  ) -> AsyncGenerator[Issue, None]:
-    params = {'state': state}
-    if labels:
-      params['labels'] = labels
-    j, r = await self.api_request(f'/repos/{repo}/issues', params = params)
-    assert isinstance(j, list)
+  async def _paginate(
+    self, path: str, factory: Callable[[JsonDict], Any],
+    concurrent: bool = True, **kwargs,
+  ) -> AsyncGenerator[Any, None]:
+    '''yield factory(x) for objects on all pages
 
+    If concurrent is true and the first page links to the last one, the
+    remaining pages are fetched page_concurrency at a time.'''
+    j, r = await self.api_request(path, **kwargs)
+    assert isinstance(j, list)
     for x in j:
-      yield Issue(x, self)
+      yield factory(x)
+
+    if concurrent and 'last' in r.links and 'next' in r.links:
+      next_url = urlsplit(str(r.links['next']['url']))
+      last_url = urlsplit(str(r.links['last']['url']))
+      query = parse_qs(next_url.query)
+      first = int(query['page'][0])
+      last = int(parse_qs(last_url.query)['page'][0])
+      urls = []
+      for page in range(first, last + 1):
+        query['page'] = [str(page)]
+        urls.append(urlunsplit(
+          next_url._replace(query=urlencode(query, doseq=True))))
+
+      step = self.page_concurrency
+      for i in range(0, len(urls), step):
+        pages = await asyncio.gather(*(
+          self.api_request(url) for url in urls[i:i+step]))
+        for j, _ in pages:
+          assert isinstance(j, list)
+          for x in j:
+            yield factory(x)
+      return
 
     while 'next' in r.links:
       url = str(r.links['next']['url'])
       j, r = await self.api_request(url)
       assert isinstance(j, list)
       for x in j:
-        yield Issue(x, self)
+        yield factory(x)
+
+  async def get_repo_issues(
+    self, repo: str, *, state: str = 'open', labels: str = '',
+    concurrent: bool = True,
+  ) -> AsyncGenerator[Issue, None]:
+    params = {'state': state}
+    if labels:
+      params['labels'] = labels
+    async for issue in self._paginate(
+      f'/repos/{repo}/issues', lambda x: Issue(x, self),
+      concurrent = concurrent, params = params,
+    ):
+      yield issue
 
   async def get_issue(self, repo: str, issue_nr: int) -> 'Issue':
     j, _ = await self.api_request(f'/repos/{repo}/issues/{issue_nr}')
@@ -95,20 +261,141 @@ class GitHub(httpxutils.ClientBase):
     return Issue(j, self)
 
   async def get_issue_comments(
-    self, repo: str, issue_nr: int,
+    self, repo: str, issue_nr: int, *, concurrent: bool = True,
   ) -> AsyncGenerator[Comment, None]:
-    j, r = await self.api_request(f'/repos/{repo}/issues/{issue_nr}/comments')
-
-    assert isinstance(j, list)
-    for x in j:
-      yield Comment(x, self)
-
-    while 'next' in r.links:
-      url = str(r.links['next']['url'])
-      j, r = await self.api_request(url)
-      assert isinstance(j, list)
-      for x in j:
-        yield Comment(x, self)
+    async for comment in self._paginate(
+      f'/repos/{repo}/issues/{issue_nr}/comments',
+      lambda x: Comment(x, self), concurrent = concurrent,
+    ):
+      yield comment
+
+  async def graphql(
+    self, query: str, variables: Optional[JsonDict] = None, *,
+    partial: bool = False,
+  ) -> JsonDict:
+    '''run a GraphQL query and return its data
+
+    With partial, NOT_FOUND errors are logged instead of raised when
+    there's data, leaving the fields concerned null.'''
+    j, _ = await self.api_request(
+      self.graphql_url, method = 'post',
+      data = {'query': query, 'variables': variables or {}},
+    )
+    assert isinstance(j, dict)
+    errors = j.get('errors') or []
+    if partial and j.get('data') is not None:
+      for e in errors:
+        if e.get('type') == 'NOT_FOUND':
+          logger.warning('GraphQL: %s', e['message'])
+      errors = [e for e in errors if e.get('type') != 'NOT_FOUND']
+    if errors:
+      e = errors[0]
+      raise GitHubError(e['message'], e.get('type'), 200)
+    return j['data']
+
+  def _issue_from_graphql(self, repo: str, x: JsonDict) -> 'Issue':
+    '''build an Issue from a GraphQL node as if it came from the REST API'''
+    number = x['number']
+    data = {
+      'number': number,
+      'title': x['title'],
+      'body': x['body'],
+      'state': x['state'].lower(),
+      'updated_at': x['updatedAt'],
+      'url': urljoin(self.baseurl, f'/repos/{repo}/issues/{number}'),
+      'html_url': x['url'],
+      'user': {'login': (x['author'] or {'login': 'ghost'})['login']},
+      'labels': x['labels']['nodes'],
+      'assignees': x['assignees']['nodes'],
+    }
+    return Issue(data, self)
+
+  def _comment_from_graphql(self, repo: str, x: JsonDict) -> 'Comment':
+    data = {
+      'id': x['databaseId'],
+      'url': urljoin(
+        self.baseurl, f'/repos/{repo}/issues/comments/{x["databaseId"]}'),
+      'html_url': x['url'],
+      'body': x['body'],
+      'user': {'login': (x['author'] or {'login': 'ghost'})['login']},
+    }
+    return Comment(data, self)
+
+  async def _more_comments(
+    self, repo: str, number: int, cursor: str,
+  ) -> List[JsonDict]:
+    owner, name = repo.split('/', 1)
+    ret = []
+    while cursor:
+      d = await self.graphql(_GRAPHQL_MORE_COMMENTS, {
+        'owner': owner, 'name': name, 'number': number, 'after': cursor,
+      })
+      comments = d['repository']['issue']['comments']
+      ret.extend(comments['nodes'])
+      info = comments['pageInfo']
+      cursor = info['endCursor'] if info['hasNextPage'] else None
+    return ret
+
+  async def _complete_issues(
+    self, repo: str, nodes: List[JsonDict],
+  ) -> List[Tuple['Issue', List['Comment']]]:
+    more = [
+      (x, self._more_comments(repo, x['number'], x['comments']['pageInfo']['endCursor']))
+      for x in nodes if x['comments']['pageInfo']['hasNextPage']
+    ]
+    if more:
+      rest = await asyncio.gather(*(c for _, c in more))
+      for (x, _), r in zip(more, rest):
+        x['comments']['nodes'].extend(r)
+
+    return [(
+      self._issue_from_graphql(repo, x),
+      [self._comment_from_graphql(repo, c) for c in x['comments']['nodes']],
+    ) for x in nodes]
+
+  async def get_issues_with_comments(
+    self, repo: str, numbers: Optional[List[int]] = None, *,
+    state: str = 'open', batch_size: int = 50,
+  ) -> AsyncGenerator[Tuple['Issue', List['Comment']], None]:
+    '''yield (issue, comments) using batched GraphQL queries
+
+    If numbers is given, those issues are fetched, batch_size per query;
+    otherwise all issues in state ('open', 'closed' or 'all') are walked
+    with cursor pagination. Comments beyond the first 100 of an issue are
+    fetched with further queries. Pull requests aren't included, nor are
+    numbers that don't exist or are pull requests.'''
+    owner, name = repo.split('/', 1)
+    if numbers is not None:
+      for i in range(0, len(numbers), batch_size):
+        batch = numbers[i:i+batch_size]
+        fields = '\n'.join(
+          f'i{n}: issue(number: {int(n)}) {{ ...issueFields }}' for n in batch)
+        d = await self.graphql(
+          'query($owner: String!, $name: String!) {'
+          f' repository(owner: $owner, name: $name) {{ {fields} }} }}'
+          + _GRAPHQL_ISSUE_FIELDS,
+          {'owner': owner, 'name': name}, partial = True,
+        )
+        r = d['repository']
+        nodes = [r[f'i{n}'] for n in batch if r.get(f'i{n}')]
+        for x in await self._complete_issues(repo, nodes):
+          yield x
+      return
+
+    states = ['OPEN', 'CLOSED'] if state == 'all' else [state.upper()]
+    cursor = None
+    while True:
+      d = await self.graphql(_GRAPHQL_ISSUES, {
+        'owner': owner, 'name': name, 'states': states,
+        'first': batch_size, 'after': cursor,
+      })
+      issues = d['repository']['issues']
+      for x in await self._complete_issues(repo, issues['nodes']):
+        yield x
+      info = issues['pageInfo']
+      if not info['hasNextPage']:
+        break
+      cursor = info['endCursor']
 
   async def create_issue(
     self, repo: str, title: str, body: Optional[str] = None,
@@ -147,6 +434,7 @@ class Issue:
     self.number = data['number']
     self.title = data['title']
     self.labels = [x['name'] for x in data['labels']]
+    self.assignees = [x['login'] for x in data.get('assignees') or []]
     self.updated_at = parse_datetime(data['updated_at'])
     # pr or issue
     self._api_url = data.get('issue_url', data['url'])
@@ -1,11 +1,84 @@
 import os
+import json
 from http.cookiejar import MozillaCookieJar
 from urllib.parse import urljoin
-from typing import Optional
+from typing import Optional, Union
+from http import HTTPStatus
 import asyncio
 
 import aiohttp
 from aiohttp.client import ClientResponse
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from httpcache import HttpCache, CacheEntry
+
+class CachedResponse:
+  '''A response to a GET request that went through the cache
+
+  It supports the commonly used parts of ClientResponse.
+
+  >>> r = CachedResponse(CacheEntry('http://example.com/', 404, [], b'', 0))
+  >>> try:
+  ...   r.raise_for_status()
+  ... except aiohttp.ClientResponseError as e:
+  ...   print(e)
+  404, message='Not Found', url='http://example.com/'
+  '''
+  def __init__(self, entry: CacheEntry) -> None:
+    self.status = entry.status
+    self.headers = CIMultiDictProxy(CIMultiDict(entry.headers))
+    self.url = URL(entry.url)
+    self.from_cache = entry.hit
+    self._body = entry.body
+
+  @property
+  def content_type(self) -> str:
+    return self.headers.get('Content-Type', '').split(';')[0].strip()
+
+  @property
+  def charset(self) -> Optional[str]:
+    for part in self.headers.get('Content-Type', '').split(';')[1:]:
+      k, _, v = part.strip().partition('=')
+      if k.lower() == 'charset':
+        return v.strip('"')
+    return None
+
+  @property
+  def ok(self) -> bool:
+    return self.status < 400
+
+  async def read(self) -> bytes:
+    return self._body
+
+  async def text(self, encoding: Optional[str] = None, errors: str = 'strict') -> str:
+    return self._body.decode(encoding or self.charset or 'utf-8', errors)
+
+  async def json(self, *, loads=json.loads, **kwargs):
+    return loads(await self.text())
+
+  def raise_for_status(self) -> None:
+    if not self.ok:
+      try:
+        reason = HTTPStatus(self.status).phrase
+      except ValueError:
+        reason = ''
+      raise aiohttp.ClientResponseError(
+        aiohttp.RequestInfo(self.url, 'GET', self.headers, self.url), (),
+        status=self.status, message=reason, headers=self.headers,
+      )
+
+  def release(self) -> None:
+    pass
+
+  async def __aenter__(self) -> 'CachedResponse':
+    return self
+
+  async def __aexit__(self, *exc) -> None:
+    pass
+
+  def __repr__(self) -> str:
+    return f'<CachedResponse({self.url}) [{self.status}]>'
 
 class ClientBase:
   session = None
@@ -14,13 +87,17 @@ class ClientBase:
   auto_referer = False
   baseurl: Optional[str] = None
   cookiefile: Optional[os.PathLike] = None
+  # GET requests go through this cache if set
+  cache: Optional[HttpCache] = None
   __our_session: bool = False
 
-  def __init__(self, *, baseurl=None, cookiefile=None, session=None):
+  def __init__(self, *, baseurl=None, cookiefile=None, session=None, cache=None):
     if baseurl is not None:
       self.baseurl = baseurl
     self.session = session
     self.cookiefile = cookiefile
+    if cache is not None:
+      self.cache = cache
 
   async def async_init(self) -> None:
     if not self.session:
@@ -44,7 +121,7 @@ class ClientBase:
 
   async def request(
     self, url: str, method: Optional[str] = None, **kwargs,
-  ) -> ClientResponse:
+  ) -> Union[ClientResponse, CachedResponse]:
     if not self.session:
       await self.async_init()
 
@@ -69,11 +146,28 @@ class ClientBase:
       else:
         method = 'get'
 
-    response = await self.session.request(method, url, **kwargs) # type: ignore
+    if self.cache is not None and method.lower() == 'get':
+      response = await self._cached_request(url, **kwargs)
+    else:
+      response = await self.session.request(method, url, **kwargs) # type: ignore
     # url may have been changed due to redirection
     self.lasturl = str(response.url)
     return response
 
+  async def _cached_request(self, url: str, **kwargs) -> CachedResponse:
+    full = str(URL(url).update_query(kwargs.pop('params', None) or {}))
+    headers = kwargs.pop('headers', None) or {}
+
+    async def fetch(validators):
+      async with self.session.request( # type: ignore
+        'get', full, headers={**headers, **validators}, **kwargs,
+      ) as r:
+        body = await r.read()
+        return str(r.url), r.status, list(r.headers.items()), body
+
+    entry = await self.cache.fetch(full, fetch) # type: ignore
+    return CachedResponse(entry)
+
 async def test():
   client = ClientBase(baseurl='https://www.baidu.com/', cookiefile='test')
   res = await client.request('/')
@@ -6,10 +6,21 @@ In [2]: %timeit colorfinder.hex2term_accurate('#434519')
 
 In [3]: %timeit colorfinder.hex2term_quick('#434519')
 100000 loops, best of 3: 12.2 µs per loop
+
+For many colors, use hex2term_many (vectorized with NumPy if available),
+or a TermColorTable, which remembers the results for quantized colors
+and can be saved to disk.
 '''
 
+import os
 from math import sqrt, degrees, atan2, fabs, cos, radians, sin, exp
 from functools import lru_cache
+from typing import Iterable, List, Optional
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
 def parsehex_float(c):
   return tuple(int(x, 16)/255.0 for x in (c[1:3], c[3:5], c[5:7]))
@@ -157,16 +168,176 @@ def delta_e_cie2000(color1, color2):
 def prepare_map(hexrgbmap):
   return {
     k: rgb2lab(parsehex_float(v))
-    for k, v in termcolors.items()
+    for k, v in hexrgbmap.items()
   }
 
-@lru_cache(300)
-def hex2term_accurate(color):
+def _get_termcolors_map():
   global _termcolors_map
   if _termcolors_map is None:
     _termcolors_map = prepare_map(termcolors)
+  return _termcolors_map
+
+@lru_cache(300)
+def hex2term_accurate(color):
+  return best_match(parsehex_float(color), _get_termcolors_map())[0]
+
+def rgb2lab_array(rgb):
+  '''RGB to Lab for an (N, 3) array of floats in [0, 1]'''
+  rgb = np.asarray(rgb, dtype=float)
+  rgb = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+  xyz = rgb @ np.array([
+    [0.4124, 0.2126, 0.0193],
+    [0.3576, 0.7152, 0.1192],
+    [0.1805, 0.0722, 0.9505],
+  ]) * 100
+  xyz /= (95.047, 100.000, 108.883)
+  xyz = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16 / 116)
+  X, Y, Z = xyz.T
+  return np.stack([116 * Y - 16, 500 * (X - Y), 200 * (Y - Z)], axis=-1)
+
+def delta_e_cie2000_array(lab1, lab2):
+  '''delta_e_cie2000 between all pairs of (N, 3) lab1 and (M, 3) lab2
+
+  Returns an (N, M) array. Same computation as delta_e_cie2000.'''
+  L1, a1, b1 = (x[:, None] for x in np.asarray(lab1, dtype=float).T)
+  L2, a2, b2 = (x[None, :] for x in np.asarray(lab2, dtype=float).T)
+
+  avg_Lp = (L1 + L2) / 2.0
+  C1 = np.hypot(a1, b1)
+  C2 = np.hypot(a2, b2)
+  avg_C1_C2 = (C1 + C2) / 2.0
+  c7 = avg_C1_C2 ** 7
+  G = 0.5 * (1 - np.sqrt(c7 / (c7 + 25.0 ** 7)))
+
+  a1p = (1.0 + G) * a1
+  a2p = (1.0 + G) * a2
+  C1p = np.hypot(a1p, b1)
+  C2p = np.hypot(a2p, b2)
+  avg_C1p_C2p = (C1p + C2p) / 2.0
+
+  h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+  h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+
+  avg_Hp = np.where(np.abs(h1p - h2p) > 180,
+                    (h1p + h2p + 360) / 2.0, (h1p + h2p) / 2.0)
+  T = (1 - 0.17 * np.cos(np.radians(avg_Hp - 30))
+       + 0.24 * np.cos(np.radians(2 * avg_Hp))
+       + 0.32 * np.cos(np.radians(3 * avg_Hp + 6))
+       - 0.2 * np.cos(np.radians(4 * avg_Hp - 63)))
+
+  diff_h2p_h1p = h2p - h1p
+  delta_hp = np.where(
+    np.abs(diff_h2p_h1p) <= 180, diff_h2p_h1p,
+    np.where(h2p <= h1p, diff_h2p_h1p + 360, diff_h2p_h1p - 360))
+
+  delta_Lp = L2 - L1
+  delta_Cp = C2p - C1p
+  delta_Hp = 2 * np.sqrt(C2p * C1p) * np.sin(np.radians(delta_hp) / 2.0)
+
+  S_L = 1 + ((0.015 * (avg_Lp - 50) ** 2) / np.sqrt(20 + (avg_Lp - 50) ** 2))
+  S_C = 1 + 0.045 * avg_C1p_C2p
+  S_H = 1 + 0.015 * avg_C1p_C2p * T
 
-  return best_match(parsehex_float(color), _termcolors_map)[0]
+  delta_ro = 30 * np.exp(-(((avg_Hp - 275) / 25) ** 2))
+  c7p = avg_C1p_C2p ** 7
+  R_C = np.sqrt(c7p / (c7p + 25.0 ** 7))
+  R_T = -2 * R_C * np.sin(2 * np.radians(delta_ro))
+
+  dL = delta_Lp / S_L
+  dC = delta_Cp / S_C
+  dH = delta_Hp / S_H
+  return np.sqrt(dL ** 2 + dC ** 2 + dH ** 2 + R_T * dC * dH)
+
+def _best_match_array(rgb, chunk=4096):
+  '''indexes into termcolors for an (N, 3) array of floats in [0, 1]'''
+  m = _get_termcolors_map()
+  keys = np.array(list(m.keys()))
+  palette = np.array(list(m.values()))
+  lab = rgb2lab_array(rgb)
+  ret = np.empty(len(lab), dtype=int)
+  for i in range(0, len(lab), chunk):
+    d = delta_e_cie2000_array(palette, lab[i:i+chunk])
+    ret[i:i+chunk] = keys[d.argmin(axis=0)]
+  return ret
+
+def hex2term_many(colors: Iterable[str]) -> List[int]:
+  '''hex2term_accurate for many colors at once
+
+  Distinct colors are computed in one pass with NumPy if available.'''
+  colors = list(colors)
+  uniq = list(dict.fromkeys(colors))
+  if np is None:
+    result = {c: hex2term_accurate(c) for c in uniq}
+  else:
+    rgb = [parsehex_float(c) for c in uniq]
+    result = dict(zip(uniq, _best_match_array(rgb).tolist()))
+  return [result[c] for c in colors]
+
+class TermColorTable:
+  '''An RGB to xterm-256 table, quantized to bits per channel
+
+  Each entry is computed on first use (or all at once with fill()) and
+  can be saved to a file to be loaded next time, making lookups O(1).'''
+  def __init__(self, path: Optional[str] = None, bits: int = 6) -> None:
+    if not 4 <= bits <= 8:
+      raise ValueError('bits should be between 4 and 8')
+    self.path = path
+    self.bits = bits
+    size = 1 << 3 * bits
+    self.table = None
+    if path is not None:
+      try:
+        with open(path, 'rb') as f:
+          data = f.read()
+        if len(data) == size:
+          self.table = bytearray(data)
+      except FileNotFoundError:
+        pass
+    if self.table is None:
+      # 0 marks an entry not computed yet; termcolors starts at 16
+      self.table = bytearray(size)
+    self.dirty = False
+
+  def _color_of(self, idx: int) -> str:
+    bits = self.bits
+    mask = (1 << bits) - 1
+    shift = 8 - bits
+    ret = []
+    for q in (idx >> 2 * bits, idx >> bits & mask, idx & mask):
+      ret.append(q << shift | q >> (bits - shift))
+    return '#%02x%02x%02x' % tuple(ret)
+
+  def _index_of(self, color: str) -> int:
+    shift = 8 - self.bits
+    r, g, b = parsehex_int(color)
+    return ((r >> shift) << self.bits | g >> shift) << self.bits | b >> shift
+
+  def lookup(self, color: str) -> int:
+    idx = self._index_of(color)
+    v = self.table[idx]
+    if not v:
+      v = self.table[idx] = hex2term_accurate(self._color_of(idx))
+      self.dirty = True
+    return v
+
+  def fill(self) -> None:
+    '''compute all missing entries'''
+    missing = [i for i, v in enumerate(self.table) if not v]
+    if not missing:
+      return
+    colors = [self._color_of(i) for i in missing]
+    for i, v in zip(missing, hex2term_many(colors)):
+      self.table[i] = v
+    self.dirty = True
+
+  def save(self, path: Optional[str] = None) -> None:
+    from myutils import safe_overwrite
+    path = path or self.path
+    if path is None:
+      raise ValueError('no path to save to')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    safe_overwrite(path, bytes(self.table), mode='wb')
+    self.dirty = False
 
 def _hex2term_quick(red, green, blue):
   # from ruby-paint
@@ -1,36 +1,143 @@
-from collections import UserDict
+from collections import UserDict, OrderedDict
+from collections.abc import ItemsView, ValuesView
+from itertools import count
+import heapq
 import time
 
 class ExpiringDict(UserDict):
+  '''A dict with per-item TTL and LRU eviction beyond maxsize
+
+  Expired items are dropped lazily on access, and in amortized O(log n)
+  from a deadline heap by expire() and on insertion. Hits, misses,
+  evictions and expirations are counted in the attributes of the same
+  names.
+
+  Only explicit access (d[key], get) counts as a use for LRU; iterating
+  doesn't reorder or drop anything, and skips expired items:
+
+  >>> d = ExpiringDict(60)
+  >>> d['a'] = 1; d['b'] = 2
+  >>> d.set_item('c', 3, ttl=-1)
+  >>> list(d.items())
+  [('a', 1), ('b', 2)]
+  >>> list(d.values())
+  [1, 2]
+  >>> list(d)
+  ['a', 'b']
+  '''
   def __init__(self, default_ttl, maxsize=100):
     super().__init__()
+    self.data = OrderedDict()
     self.default_ttl = default_ttl
     self.maxsize = maxsize
+    # (deadline, seq, key); entries for overwritten or deleted keys are
+    # left in place and skipped when popped
+    self._heap = []
+    self._seq = count()
+    self.hits = self.misses = self.evictions = self.expirations = 0
 
   def __getitem__(self, key):
-    item, t = self.data[key]
+    try:
+      item, t = self.data[key]
+    except KeyError:
+      self.misses += 1
+      raise
+    if t < time.monotonic():
+      del self.data[key]
+      self.expirations += 1
+      self.misses += 1
+      raise KeyError(key)
+    self.data.move_to_end(key)
+    self.hits += 1
     return item
 
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def __contains__(self, key):
+    try:
+      _, t = self.data[key]
+    except KeyError:
+      return False
+    return t >= time.monotonic()
+
+  def _live_items(self):
+    now = time.monotonic()
+    for key, (item, t) in self.data.items():
+      if t >= now:
+        yield key, item
+
+  def __iter__(self):
+    return (key for key, _ in self._live_items())
+
+  def items(self):
+    return _ItemsView(self)
+
+  def values(self):
+    return _ValuesView(self)
+
   def __setitem__(self, key, value):
     self.set_item(key, value)
 
   def set_item(self, key, value, ttl=None):
     if ttl is None:
       ttl = self.default_ttl
-    t = time.time() + ttl
-    self.data[key] = value, t
+    now = time.monotonic()
+    t = now + ttl
+    data = self.data
+    data[key] = value, t
+    data.move_to_end(key)
+    heapq.heappush(self._heap, (t, next(self._seq), key))
+
+    if len(data) > self.maxsize:
+      self._expire(now)
+      while len(data) > self.maxsize:
+        data.popitem(last=False)
+        self.evictions += 1
+
+    if len(self._heap) > 2 * len(data) + 64:
+      self._compact()
 
   def __delitem__(self, key):
     del self.data[key]
 
+  def _expire(self, now):
+    heap = self._heap
+    data = self.data
+    while heap and heap[0][0] < now:
+      t, _, key = heapq.heappop(heap)
+      item = data.get(key)
+      if item is not None and item[1] == t:
+        del data[key]
+        self.expirations += 1
+
+  def _compact(self):
+    seq = self._seq
+    self._heap = [(t, next(seq), k) for k, (_, t) in self.data.items()]
+    heapq.heapify(self._heap)
+
   def expire(self):
-    now = time.time()
-    expired_keys = [k for k, (_, t) in self.data.items() if t < now]
-    for k in expired_keys:
-      del self.data[k]
-
-    if len(self.data) > self.maxsize:
-      keys = [k for k, _ in sorted(self.data.items(), key=lambda x: x[1][1])]
-      overflowed = keys[-self.maxsize:]
-      for k in overflowed:
-        del self.data[k]
+    self._expire(time.monotonic())
+
+  def stats(self):
+    return {
+      'size': len(self.data),
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+      'expirations': self.expirations,
+    }
+
+class _ItemsView(ItemsView):
+  def __iter__(self):
+    return self._mapping._live_items()
+
+class _ValuesView(ValuesView):
+  def __iter__(self):
+    return (item for _, item in self._mapping._live_items())
+
+  def __contains__(self, value):
+    return any(v is value or v == value for v in self)
@@ -8,8 +8,9 @@ Read and write ZIP files.
 
 XXX references to utf-8 need further investigation.
 """
-import struct, os, time, sys, shutil
-import binascii, io, stat
+import struct, os, time, sys, re
+import binascii, io, stat, random
+from array import array
 
 try:
     import zlib # We may need its compression method
@@ -18,9 +19,30 @@ except ImportError:
     zlib = None
     crc32 = binascii.crc32
 
+# optional compiled ZipCrypto decryptor, built by pyso/makeso
+try:
+    import ctypes
+    from myutils import loadso
+    _zipcrypto = loadso('_zipcrypto.so')
+    _zipcrypto.zipcrypto_decrypt.argtypes = [
+        ctypes.POINTER(ctypes.c_uint32), ctypes.c_void_p, ctypes.c_size_t]
+    _zipcrypto.zipcrypto_decrypt.restype = None
+except (ImportError, OSError):
+    _zipcrypto = None
+
 __all__ = ["BadZipfile", "error", "ZIP_STORED", "ZIP_DEFLATED", "is_zipfile",
            "ZipInfo", "ZipFile", "PyZipFile", "LargeZipFile" ]
 
+# sidecar index of central directory entry offsets: magic, archive size,
+# archive mtime in ns, central directory start, its size, concat, number of
+# entries, comment length and file name encoding
+structIndexHeader = "<4sQqQQqQI16s"
+stringIndex = b"GBZ1"
+sizeIndexHeader = struct.calcsize(structIndexHeader)
+
+# buffer size for extracting members
+COPY_BUFSIZE = 1024 * 1024
+
 class BadZipfile(Exception):
     pass
 
@@ -270,6 +292,7 @@ class ZipInfo (object):
             'compress_size',
             'file_size',
             '_raw_time',
+            '_raw_filename',
         )
 
     def __init__(self, filename="NoName", date_time=(1980,1,1,0,0,0)):
@@ -287,6 +310,7 @@ class ZipInfo (object):
             filename = filename.replace(os.sep, "/")
 
         self.filename = filename        # Normalized file name
+        self._raw_filename = None       # File name bytes as in the archive
         self.date_time = date_time      # year, month, day, hour, min, sec
         # Standard values:
         self.compress_type = ZIP_STORED # Type of compression for the file
@@ -397,7 +421,7 @@ class _ZipDecrypter:
     Usage:
         zd = _ZipDecrypter(mypwd)
         plain_char = zd(cypher_char)
-        plain_text = map(zd, cypher_text)
+        plain_text = zd.decrypt(cypher_text)
     """
 
     def _GenerateCRCTable():
@@ -420,6 +444,15 @@ class _ZipDecrypter:
         return table
     crctable = _GenerateCRCTable()
 
+    def _GenerateStreamTable():
+        """The key stream byte only depends on the lower 16 bits of key2."""
+        table = bytearray(65536)
+        for i in range(65536):
+            k = i | 2
+            table[i] = ((k * (k^1)) >> 8) & 255
+        return bytes(table)
+    streamtable = None
+
     def _crc32(self, ch, crc):
         """Compute the CRC32 primitive on one byte."""
         return ((crc >> 8) & 0xffffff) ^ self.crctable[(crc ^ ch) & 0xff]
@@ -445,21 +478,76 @@ class _ZipDecrypter:
         self._UpdateKeys(c)
         return c
 
+    def decrypt(self, data):
+        """Decrypt a buffer; the same as bytes(map(self, data)), but faster."""
+        if _zipcrypto is not None:
+            keys = (ctypes.c_uint32 * 3)(self.key0, self.key1, self.key2)
+            buf = bytearray(data)
+            if buf:
+                _zipcrypto.zipcrypto_decrypt(
+                    keys, (ctypes.c_char * len(buf)).from_buffer(buf), len(buf))
+            self.key0, self.key1, self.key2 = keys
+            return bytes(buf)
+        return self._decrypt_py(data)
+
+    def _decrypt_py(self, data):
+        stream = _ZipDecrypter.streamtable
+        if stream is None:
+            stream = _ZipDecrypter.streamtable = \
+                    _ZipDecrypter._GenerateStreamTable()
+        crctable = self.crctable
+        key0, key1, key2 = self.key0, self.key1, self.key2
+        buf = bytearray(data)
+        i = 0
+        for c in data:
+            c ^= stream[key2 & 0xffff]
+            buf[i] = c
+            i += 1
+            key0 = (key0 >> 8) ^ crctable[(key0 ^ c) & 0xff]
+            key1 = ((key1 + (key0 & 255)) * 134775813 + 1) & 4294967295
+            key2 = (key2 >> 8) ^ crctable[(key2 ^ (key1 >> 24)) & 0xff]
+        self.key0, self.key1, self.key2 = key0, key1, key2
+        return bytes(buf)
+
+def benchmark_decrypt(size=1024*1024, pwd=b'password'):
+    """Compare the ZipCrypto decryptors on size bytes of random data."""
+    data = os.urandom(size)
+    results = []
+    for name, f in (
+        ('per-byte', lambda zd: bytes(map(zd, data))),
+        ('block', lambda zd: zd._decrypt_py(data)),
+        ('compiled', lambda zd: zd.decrypt(data)),
+    ):
+        if name == 'compiled' and _zipcrypto is None:
+            print('compiled: _zipcrypto.so not available')
+            continue
+        zd = _ZipDecrypter(pwd)
+        t = time.perf_counter()
+        out = f(zd)
+        t = time.perf_counter() - t
+        results.append(out)
+        print('%-8s: %8.3fs, %8.2f MiB/s' % (name, t, size / t / 1048576))
+    if any(r != results[0] for r in results):
+        raise AssertionError('decrypted output differs')
+
 class ZipExtFile:
     """File-like object for reading an archive member.
        Is returned by ZipFile.open().
     """
 
+    # matches the first line separator in universal newlines mode
+    _univ_nl_re = re.compile(b'\r\n|\r|\n')
+
     def __init__(self, fileobj, zipinfo, decrypt=None):
         self.fileobj = fileobj
         self.decrypter = decrypt
         self.bytes_read = 0
         self.rawbuffer = b''
-        self.readbuffer = b''
-        self.linebuffer = b''
+        # decompressed data; the unread part starts at readpos
+        self.readbuffer = bytearray()
+        self.readpos = 0
         self.eof = False
         self.univ_newlines = False
-        self.nlSeps = (b"\n", )
         self.lastdiscard = b''
 
         self.compress_type = zipinfo.compress_type
@@ -469,19 +557,14 @@ class ZipExtFile:
         self.mode    = "r"
         self.name = zipinfo.filename
 
-        # read from compressed files in 64k blocks
-        self.compreadsize = 64*1024
+        # read from compressed files in 256k blocks
+        self.compreadsize = 256*1024
         if self.compress_type == ZIP_DEFLATED:
             self.dc = zlib.decompressobj(-15)
 
     def set_univ_newlines(self, univ_newlines):
         self.univ_newlines = univ_newlines
 
-        # pick line separator char(s) based on universal newlines flag
-        self.nlSeps = (b"\n", )
-        if self.univ_newlines:
-            self.nlSeps = (b"\r\n", b"\r", b"\n")
-
     def __iter__(self):
         return self
 
@@ -495,22 +578,23 @@ class ZipExtFile:
     def close(self):
         self.closed = True
 
-    def _checkfornewline(self):
-        nl, nllen = -1, -1
-        if self.linebuffer:
-            # ugly check for cases where half of an \r\n pair was
-            # read on the last pass, and the \r was discarded.  In this
-            # case we just throw away the \n at the start of the buffer.
-            if (self.lastdiscard, self.linebuffer[:1]) == (b'\r', b'\n'):
-                self.linebuffer = self.linebuffer[1:]
-
-            for sep in self.nlSeps:
-                nl = self.linebuffer.find(sep)
-                if nl >= 0:
-                    nllen = len(sep)
-                    return nl, nllen
-
-        return nl, nllen
+    def _findnewline(self, end, final):
+        """Find the first line separator in readbuffer[readpos:end].
+           Return (position, length of separator), or (-1, -1).
+        """
+        buf = self.readbuffer
+        if self.univ_newlines:
+            m = self._univ_nl_re.search(buf, self.readpos, end)
+            if m is None:
+                return -1, -1
+            # a \r at the end of data may be the first half of \r\n
+            start, end = m.span()
+            if end == len(buf) and buf[start:end] == b'\r' and not final:
+                return -1, -1
+            return start, end - start
+        else:
+            nl = buf.find(b'\n', self.readpos, end)
+            return (nl, 1) if nl >= 0 else (-1, -1)
 
     def readline(self, size = -1):
         """Read a line with approx. size. If size is negative,
@@ -521,40 +605,52 @@ class ZipExtFile:
         elif size == 0:
             return b''
 
-        # check for a newline already in buffer
-        nl, nllen = self._checkfornewline()
-
-        if nl >= 0:
-            # the next line was already in the buffer
-            nl = min(nl, size)
-        else:
+        if not self.univ_newlines:
+            # fast path: the line is returned as is
+            while True:
+                buf = self.readbuffer
+                pos = self.readpos
+                end = min(len(buf), pos + size)
+                nl = buf.find(b'\n', pos, end)
+                if nl >= 0:
+                    line = bytes(buf[pos:nl + 1])
+                    self._consume(nl + 1 - pos)
+                    return line
+                if end - pos >= size or \
+                   not self._fill(len(buf) - pos + 65536):
+                    return self._take(size)
+
+        final = False
+        while True:
+            buf = self.readbuffer
+            if self.lastdiscard == b'\r' and len(buf) > self.readpos:
+                # ugly check for cases where half of an \r\n pair was
+                # read on the last pass, and the \r was discarded.  In this
+                # case we just throw away the \n at the start of the buffer.
+                if buf[self.readpos] == 0x0a:
+                    self.readpos += 1
+                self.lastdiscard = b''
+
+            end = min(len(buf), self.readpos + size)
+            nl, nllen = self._findnewline(end, final)
+            if nl >= 0:
+                line = bytes(buf[self.readpos:nl])
+                self.lastdiscard = b'\r' if nllen == 1 and buf[nl] == 0x0d else b''
+                self._consume(nl + nllen - self.readpos)
+                # line is always returned with \n as newline char (except
+                # possibly for a final incomplete line in the file, which is
+                # handled below).
+                return line + b"\n"
+
+            if final or end - self.readpos >= size:
+                break
             # no line break in buffer - try to read more
-            size -= len(self.linebuffer)
-            while nl < 0 and size > 0:
-                buf = self.read(min(size, 100))
-                if not buf:
-                    break
-                self.linebuffer += buf
-                size -= len(buf)
-
-                # check for a newline in buffer
-                nl, nllen = self._checkfornewline()
-
-            # we either ran out of bytes in the file, or
-            # met the specified size limit without finding a newline,
-            # so return current buffer
-            if nl < 0:
-                s = self.linebuffer
-                self.linebuffer = b''
-                return s
+            if not self._fill(len(buf) - self.readpos + 65536):
+                final = True
 
-        buf = self.linebuffer[:nl]
-        self.lastdiscard = self.linebuffer[nl:nl + nllen]
-        self.linebuffer = self.linebuffer[nl + nllen:]
-
-        # line is always returned with \n as newline char (except possibly
-        # for a final incomplete line in the file, which is handled above).
-        return buf + b"\n"
+        # we either ran out of bytes in the file, or met the specified size
+        # limit without finding a newline, so return current buffer
+        return self._take(size)
 
     def readlines(self, sizehint = -1):
         """Return a list with all (following) lines. The sizehint parameter
@@ -567,11 +663,37 @@ class ZipExtFile:
             result.append(line)
         return result
 
-    def read(self, size = None):
-        # act like file obj and return empty string if size is 0
-        if size == 0:
-            return b''
+    def _consume(self, n):
+        pos = self.readpos = self.readpos + n
+        # drop consumed data once it makes up most of the buffer
+        if pos > 65536 or pos >= len(self.readbuffer):
+            if pos >= len(self.readbuffer):
+                self.readbuffer.clear()
+                self.readpos = 0
+            elif pos * 2 > len(self.readbuffer):
+                del self.readbuffer[:pos]
+                self.readpos = 0
+
+    def _take(self, size):
+        """Return at most size (None for all) buffered bytes."""
+        buf = self.readbuffer
+        if size is None or size < 0 or len(buf) - self.readpos <= size:
+            if self.readpos:
+                data = bytes(buf[self.readpos:])
+            else:
+                data = bytes(buf)
+            buf.clear()
+            self.readpos = 0
+        else:
+            data = bytes(buf[self.readpos:self.readpos + size])
+            self._consume(size)
+        return data
 
+    def _fill(self, size):
+        """Read (at most once) from the file and decrypt and decompress
+           into readbuffer, for a read of size bytes (None for all).
+           Return whether there were raw data to process.
+        """
         # determine read size
         bytesToRead = self.compress_size - self.bytes_read
 
@@ -580,12 +702,12 @@ class ZipExtFile:
         if self.decrypter is not None:
             bytesToRead -= 12
 
+        avail = len(self.readbuffer) - self.readpos
         if size is not None and size >= 0:
             if self.compress_type == ZIP_STORED:
-                lr = len(self.readbuffer)
-                bytesToRead = min(bytesToRead, size - lr)
+                bytesToRead = min(bytesToRead, size - avail)
             elif self.compress_type == ZIP_DEFLATED:
-                if len(self.readbuffer) > size:
+                if avail > size:
                     # the user has requested fewer bytes than we've already
                     # pulled through the decompressor; don't read any more
                     bytesToRead = 0
@@ -599,55 +721,73 @@ class ZipExtFile:
             bytesToRead = self.compress_size - self.bytes_read
 
         # try to read from file (if necessary)
-        if bytesToRead > 0:
-            data = self.fileobj.read(bytesToRead)
-            self.bytes_read += len(data)
-            try:
-                self.rawbuffer += data
-            except:
-                print(repr(self.fileobj), repr(self.rawbuffer),
-                      repr(data))
-                raise
-
-            # handle contents of raw buffer
-            if self.rawbuffer:
-                newdata = self.rawbuffer
-                self.rawbuffer = b''
-
-                # decrypt new data if we were given an object to handle that
-                if newdata and self.decrypter is not None:
-                    newdata = bytes(map(self.decrypter, newdata))
-
-                # decompress newly read data if necessary
-                if newdata and self.compress_type == ZIP_DEFLATED:
-                    newdata = self.dc.decompress(newdata)
-                    self.rawbuffer = self.dc.unconsumed_tail
-                    if self.eof and len(self.rawbuffer) == 0:
-                        # we're out of raw bytes (both from the file and
-                        # the local buffer); flush just to make sure the
-                        # decompressor is done
-                        newdata += self.dc.flush()
-                        # prevent decompressor from being used again
-                        self.dc = None
-
-                self.readbuffer += newdata
+        if bytesToRead <= 0:
+            return False
+
+        data = self.fileobj.read(bytesToRead)
+        self.bytes_read += len(data)
+        if self.rawbuffer:
+            self.rawbuffer += data
+        else:
+            self.rawbuffer = data
+
+        # handle contents of raw buffer
+        if not self.rawbuffer:
+            return False
+        newdata = self.rawbuffer
+        self.rawbuffer = b''
 
+        # decrypt new data if we were given an object to handle that
+        if self.decrypter is not None:
+            newdata = self.decrypter.decrypt(newdata)
+
+        # decompress newly read data if necessary
+        if self.compress_type == ZIP_DEFLATED:
+            newdata = self.dc.decompress(newdata)
+            self.rawbuffer = self.dc.unconsumed_tail
+            if self.eof and len(self.rawbuffer) == 0:
+                # we're out of raw bytes (both from the file and
+                # the local buffer); flush just to make sure the
+                # decompressor is done
+                newdata += self.dc.flush()
+                # prevent decompressor from being used again
+                self.dc = None
+
+        self.readbuffer += newdata
+        return True
+
+    def read(self, size = None):
+        # act like file obj and return empty string if size is 0
+        if size == 0:
+            return b''
 
+        self._fill(size)
         # return what the user asked for
-        if size is None or len(self.readbuffer) <= size:
-            data = self.readbuffer
-            self.readbuffer = b''
-        else:
-            data = self.readbuffer[:size]
-            self.readbuffer = self.readbuffer[size:]
+        return self._take(size)
 
-        return data
+    def readinto(self, b):
+        """Read into the writable buffer b, returning the number of bytes
+           read, which is 0 only at the end of the member.
+        """
+        mv = memoryview(b).cast('B')
+        n = len(mv)
+        if not n:
+            return 0
+        while len(self.readbuffer) == self.readpos:
+            if not self._fill(n):
+                return 0
+        pos = self.readpos
+        n = min(n, len(self.readbuffer) - pos)
+        mv[:n] = self.readbuffer[pos:pos + n]
+        self._consume(n)
+        return n
 
 
 class ZipFile:
     """ Class with methods to open, read, write, close, list zip files.
 
-    z = ZipFile(file, mode="r", compression=ZIP_STORED, allowZip64=False)
+    z = ZipFile(file, mode="r", compression=ZIP_STORED, allowZip64=False,
+                encoding=None, lazy=False, index=None)
 
     file: Either the path to the file, or a file-like object.
           If it is a path, the file will be opened and closed by ZipFile.
@@ -656,12 +796,21 @@ class ZipFile:
     allowZip64: if True ZipFile will create files with ZIP64 extensions when
                 needed, otherwise it will raise an exception when this would
                 be necessary.
+    encoding: encoding of file names without the UTF-8 flag. If None, it is
+              detected from a sample of the names.
+    lazy: (mode "r" only) build ZipInfo objects and decode names only when
+          they are needed, from a table of central directory offsets.
+    index: path of a sidecar index file to save that table in, or True for
+           file + ".idx". It is reused while the archive's size and mtime
+           stay the same, so that reopening skips the directory scan.
 
     """
 
     fp = None                   # Set here since __del__ checks it
+    _offsets = None             # Central directory offsets of entries
 
-    def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False):
+    def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False,
+                 encoding=None, lazy=False, index=None):
         """Open the ZIP file with mode read "r", write "w" or append "a"."""
         if mode not in ("r", "w", "a"):
             raise RuntimeError('ZipFile() requires mode "r", "w", or "a"')
@@ -684,6 +833,9 @@ class ZipFile:
         self.mode = key = mode.replace('b', '')[0]
         self.pwd = None
         self.comment = b''
+        self.encoding = encoding
+        self._lazy = lazy and key == 'r'
+        self._index = index
 
         # Check if we were passed a file-like object
         if isinstance(file, str):
@@ -734,6 +886,20 @@ class ZipFile:
 
     def _RealGetContents(self):
         """Read in the table of contents for the ZIP file."""
+        if not (self._index and self._loadIndex()):
+            self._scanContents()
+            if self._index:
+                self._saveIndex()
+
+        n = len(self._offsets)
+        self._infos = [None] * n
+        self._names = None
+        self._rawindex = self._irregular = None
+        if not self._lazy:
+            self._loadAll()
+
+    def _scanContents(self):
+        """Find the central directory, and the offsets of entries in it."""
         fp = self.fp
         endrec = _EndRecData(fp)
         if not endrec:
@@ -755,55 +921,223 @@ class ZipFile:
             print("given, inferred, offset", offset_cd, inferred, concat)
         # self.start_dir:  Position of start of central directory
         self.start_dir = offset_cd + concat
+        self._concat = concat
         fp.seek(self.start_dir, 0)
-        data = fp.read(size_cd)
-        fp = io.BytesIO(data)
+        data = self._cd = fp.read(size_cd)
+
+        # only the lengths are read here; entries are parsed by _getInfo
+        offsets = array('Q')
+        lengths = struct.Struct('<HHH')
         total = 0
         while total < size_cd:
-            centdir = fp.read(sizeCentralDir)
-            if centdir[0:4] != stringCentralDir:
+            if data[total:total+4] != stringCentralDir:
                 raise BadZipfile("Bad magic number for central directory")
-            centdir = struct.unpack(structCentralDir, centdir)
-            if self.debug > 2:
-                print(centdir)
-            filename = fp.read(centdir[_CD_FILENAME_LENGTH])
-            flags = centdir[5]
-            if flags & 0x800:
-                # UTF-8 file names extension
-                filename = filename.decode('utf-8')
-            else:
-                # Historical ZIP filename encoding
-                filename = filename.decode('cp936')
-            # Create ZipInfo instance to store file information
-            x = ZipInfo(filename)
-            x.extra = fp.read(centdir[_CD_EXTRA_FIELD_LENGTH])
-            x.comment = fp.read(centdir[_CD_COMMENT_LENGTH])
-            x.header_offset = centdir[_CD_LOCAL_HEADER_OFFSET]
-            (x.create_version, x.create_system, x.extract_version, x.reserved,
-                x.flag_bits, x.compress_type, t, d,
-                x.CRC, x.compress_size, x.file_size) = centdir[1:12]
-            x.volume, x.internal_attr, x.external_attr = centdir[15:18]
-            # Convert date/time code to (year, month, day, hour, min, sec)
-            x._raw_time = t
-            x.date_time = ( (d>>9)+1980, (d>>5)&0xF, d&0x1F,
-                                     t>>11, (t>>5)&0x3F, (t&0x1F) * 2 )
-
-            x._decodeExtra()
-            x.header_offset = x.header_offset + concat
-            self.filelist.append(x)
-            self.NameToInfo[x.filename] = x
-
-            # update total bytes read from central directory
-            total = (total + sizeCentralDir + centdir[_CD_FILENAME_LENGTH]
-                     + centdir[_CD_EXTRA_FIELD_LENGTH]
-                     + centdir[_CD_COMMENT_LENGTH])
-
-            if self.debug > 2:
-                print("total", total)
+            offsets.append(total)
+            n, m, k = lengths.unpack_from(data, total + 28)
+            total += sizeCentralDir + n + m + k
+        self._offsets = offsets
+
+        if self.encoding is None:
+            self.encoding = self._detectEncoding()
+
+    def _rawName(self, i):
+        """Return (flag bits, file name bytes) of the i-th entry."""
+        data = self._cd
+        pos = self._offsets[i]
+        flags, = struct.unpack_from('<H', data, pos + 8)
+        n, = struct.unpack_from('<H', data, pos + 28)
+        start = pos + sizeCentralDir
+        return flags, data[start:start+n]
+
+    def _decodeName(self, flags, name):
+        if flags & 0x800:
+            # UTF-8 file names extension
+            return name.decode('utf-8', 'surrogateescape')
+        else:
+            # Historical ZIP filename encoding
+            return name.decode(self.encoding, 'surrogateescape')
+
+    def _detectEncoding(self, samples=500):
+        """Guess the encoding of file names without the UTF-8 flag from
+           (at most) samples non-ASCII ones evenly taken from the archive.
+        """
+        n = len(self._offsets)
+        names = []
+        # random but reproducible, so that regular patterns in the names
+        # don't matter
+        for i in random.Random(n).sample(range(n), min(n, samples)):
+            flags, name = self._rawName(i)
+            if not flags & 0x800 and not name.isascii():
+                names.append(name)
+        if not names:
+            return 'gb18030'
+        for encoding in ('utf-8', 'gb18030'):
+            try:
+                for name in names:
+                    name.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+            return encoding
+        return 'cp437'
+
+    def _indexPath(self):
+        if self._index is True:
+            return self.filename + '.idx'
+        return self._index
+
+    def _indexKey(self):
+        st = os.fstat(self.fp.fileno())
+        return st.st_size, st.st_mtime_ns
+
+    def _loadIndex(self):
+        """Load the entry offsets from the sidecar index, if up to date."""
+        if self._filePassed:
+            return False
+        try:
+            with open(self._indexPath(), 'rb') as f:
+                header = f.read(sizeIndexHeader)
+                if len(header) != sizeIndexHeader:
+                    return False
+                (magic, size, mtime, start_dir, size_cd, concat, count,
+                    len_comment, encoding) = struct.unpack(
+                        structIndexHeader, header)
+                if magic != stringIndex or (size, mtime) != self._indexKey():
+                    return False
+                comment = f.read(len_comment)
+                offsets = array('Q')
+                offsets.fromfile(f, count)
+        except (OSError, EOFError, struct.error):
+            return False
+
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        self.fp.seek(start_dir, 0)
+        data = self.fp.read(size_cd)
+        if len(data) != size_cd or (count and
+                data[offsets[-1]:offsets[-1]+4] != stringCentralDir):
+            return False
+        self.start_dir = start_dir
+        self._concat = concat
+        self._cd = data
+        self._offsets = offsets
+        self.comment = comment
+        if self.encoding is None:
+            self.encoding = encoding.rstrip(b'\0').decode('ascii')
+        return True
+
+    def _saveIndex(self):
+        if self._filePassed:
+            return
+        size, mtime = self._indexKey()
+        header = struct.pack(
+            structIndexHeader, stringIndex, size, mtime, self.start_dir,
+            len(self._cd), self._concat, len(self._offsets), len(self.comment),
+            self.encoding.encode('ascii'))
+        offsets = self._offsets
+        if sys.byteorder != 'little':
+            offsets = array('Q', offsets)
+            offsets.byteswap()
+        path = self._indexPath()
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(header)
+                f.write(self.comment)
+                offsets.tofile(f)
+            os.replace(tmp, path)
+        except OSError:
+            # e.g. no write permission; it's only a cache
+            pass
 
+    def _getInfo(self, i):
+        """Return the ZipInfo for the i-th entry, creating it if needed."""
+        x = self._infos[i]
+        if x is not None:
+            return x
+
+        data = self._cd
+        pos = self._offsets[i]
+        centdir = struct.unpack(structCentralDir,
+                                data[pos:pos+sizeCentralDir])
+        if self.debug > 2:
+            print(centdir)
+        pos += sizeCentralDir
+        rawname = data[pos:pos+centdir[_CD_FILENAME_LENGTH]]
+        pos += centdir[_CD_FILENAME_LENGTH]
+        filename = self._decodeName(centdir[5], rawname)
+        # Create ZipInfo instance to store file information
+        x = ZipInfo(filename)
+        x._raw_filename = rawname
+        x.extra = data[pos:pos+centdir[_CD_EXTRA_FIELD_LENGTH]]
+        pos += centdir[_CD_EXTRA_FIELD_LENGTH]
+        x.comment = data[pos:pos+centdir[_CD_COMMENT_LENGTH]]
+        x.header_offset = centdir[_CD_LOCAL_HEADER_OFFSET]
+        (x.create_version, x.create_system, x.extract_version, x.reserved,
+            x.flag_bits, x.compress_type, t, d,
+            x.CRC, x.compress_size, x.file_size) = centdir[1:12]
+        x.volume, x.internal_attr, x.external_attr = centdir[15:18]
+        # Convert date/time code to (year, month, day, hour, min, sec)
+        x._raw_time = t
+        x.date_time = ( (d>>9)+1980, (d>>5)&0xF, d&0x1F,
+                                 t>>11, (t>>5)&0x3F, (t&0x1F) * 2 )
+
+        x._decodeExtra()
+        x.header_offset = x.header_offset + self._concat
+        self._infos[i] = x
+        return x
+
+    def _loadAll(self):
+        """Create the ZipInfo objects for all entries."""
+        if self._offsets is None:
+            return
+        for i in range(len(self._offsets)):
+            x = self._getInfo(i)
+            self._filelist.append(x)
+            self._NameToInfo[x.filename] = x
+        # they are all loaded now
+        self._offsets = None
+        self._cd = self._infos = self._names = None
+        self._rawindex = self._irregular = None
+
+    @property
+    def filelist(self):
+        self._loadAll()
+        return self._filelist
+
+    @filelist.setter
+    def filelist(self, value):
+        self._filelist = value
+
+    @property
+    def NameToInfo(self):
+        self._loadAll()
+        return self._NameToInfo
+
+    @NameToInfo.setter
+    def NameToInfo(self, value):
+        self._NameToInfo = value
 
     def namelist(self):
         """Return a list of file names in the archive."""
+        if self._offsets is not None:
+            if self._names is None:
+                names = []
+                for i in range(len(self._offsets)):
+                    x = self._infos[i]
+                    if x is None:
+                        filename = self._decodeName(*self._rawName(i))
+                        # the same as ZipInfo does
+                        null_byte = filename.find(chr(0))
+                        if null_byte >= 0:
+                            filename = filename[0:null_byte]
+                        if os.sep != "/" and os.sep in filename:
+                            filename = filename.replace(os.sep, "/")
+                        names.append(filename)
+                    else:
+                        names.append(x.filename)
+                self._names = names
+            return list(self._names)
+
         l = []
         for data in self.filelist:
             l.append(data.filename)
@@ -838,13 +1172,58 @@ class ZipFile:
 
     def getinfo(self, name):
         """Return the instance of ZipInfo given 'name'."""
-        info = self.NameToInfo.get(name)
+        if self._offsets is not None:
+            info = self._findInfo(name)
+        else:
+            info = self.NameToInfo.get(name)
         if info is None:
             raise KeyError(
                 'There is no item named %r in the archive' % name)
 
         return info
 
+    def _findInfo(self, name):
+        """Look up name without loading all entries.
+
+        The offsets cover the whole central directory, so a name that
+        isn't found is missing, unless it's one of the few names that
+        ZipInfo alters (with null bytes, or os.sep on Windows); only
+        those are checked then.
+        """
+        if self._rawindex is None:
+            # file name bytes -> index of the last entry with that name
+            data = self._cd
+            unpack = struct.Struct('<H').unpack_from
+            rawindex = {}
+            irregular = []
+            sep = os.sep.encode() if os.sep != "/" else None
+            for i, pos in enumerate(self._offsets):
+                start = pos + sizeCentralDir
+                raw = data[start:start+unpack(data, pos+28)[0]]
+                rawindex[raw] = i
+                # ZipInfo truncates names at null bytes and replaces
+                # os.sep, so these can't be found by their bytes
+                if b'\0' in raw or (sep and sep in raw):
+                    irregular.append(i)
+            self._rawindex = rawindex
+            self._irregular = irregular
+        for encoding in (self.encoding, 'utf-8'):
+            try:
+                raw = name.encode(encoding, 'surrogateescape')
+            except UnicodeEncodeError:
+                continue
+            i = self._rawindex.get(raw)
+            if i is not None:
+                x = self._getInfo(i)
+                if x.filename == name:
+                    return x
+        # the last one wins, as in NameToInfo
+        for i in reversed(self._irregular):
+            x = self._getInfo(i)
+            if x.filename == name:
+                return x
+        return None
+
     def setpassword(self, pwd):
         """Set default password for encrypted files."""
         assert isinstance(pwd, bytes)
@@ -889,7 +1268,11 @@ class ZipFile:
         if fheader[_FH_EXTRA_FIELD_LENGTH]:
             zef_file.read(fheader[_FH_EXTRA_FIELD_LENGTH])
 
-        if fname != zinfo.orig_filename.encode("gb18030"):
+        if zinfo._raw_filename is not None:
+            expected = zinfo._raw_filename
+        else:
+            expected = zinfo.orig_filename.encode("gb18030")
+        if fname != expected:
             raise BadZipfile(
                   'File name in directory %r and header %r differ.'
                   % (zinfo.orig_filename, fname))
@@ -902,7 +1285,7 @@ class ZipFile:
                 pwd = self.pwd
             if not pwd:
                 raise RuntimeError("File %s is encrypted, "
-                                   "password required for extraction" % name)
+                                   "password required for extraction" % zinfo.filename)
 
             zd = _ZipDecrypter(pwd)
             # The first 12 bytes in the cypher stream is an encryption header
@@ -911,7 +1294,7 @@ class ZipFile:
             #  or the MSB of the file time depending on the header type
             #  and is used to check the correctness of the password.
             bytes = zef_file.read(12)
-            h = list(map(zd, bytes[0:12]))
+            h = zd.decrypt(bytes[0:12])
             if zinfo.flag_bits & 0x8:
                 # compare against the file type from extended local headers
                 check_byte = (zinfo._raw_time >> 8) & 0xff
@@ -919,7 +1302,7 @@ class ZipFile:
                 # compare against the CRC otherwise
                 check_byte = (zinfo.CRC >> 24) & 0xff
             if h[11] != check_byte:
-                raise RuntimeError("Bad password for file", name)
+                raise RuntimeError("Bad password for file", zinfo.filename)
 
         # build and return a ZipExtFile
         if zd is None:
@@ -946,17 +1329,64 @@ class ZipFile:
 
         return self._extract_member(member, path, pwd)
 
-    def extractall(self, path=None, members=None, pwd=None):
+    def extractall(self, path=None, members=None, pwd=None,
+                   workers=1, processes=False):
         """Extract all members from the archive to the current working
            directory. `path' specifies a different directory to extract to.
            `members' is optional and must be a subset of the list returned
            by namelist().
+
+           With `workers' > 1, members are extracted in parallel by a
+           thread pool, or by a process pool if `processes' is true (which
+           helps when decryption isn't done by _zipcrypto.so). Each worker
+           reads the archive with its own file handle.
         """
         if members is None:
-            members = self.namelist()
+            members = self.filelist
+        members = [m if isinstance(m, ZipInfo) else self.getinfo(m)
+                   for m in members]
+        if path is None:
+            path = os.getcwd()
+
+        if workers <= 1 or self._filePassed or len(members) < 2:
+            for zipinfo in members:
+                self._extract_member(zipinfo, path, pwd)
+            return
 
+        # directories first, so that workers don't race to create them
+        files = []
         for zipinfo in members:
-            self.extract(zipinfo, path, pwd)
+            if zipinfo.filename[-1] == '/':
+                self._extract_member(zipinfo, path, pwd)
+            else:
+                files.append(zipinfo)
+        # largest first for better balance
+        files.sort(key=lambda x: x.compress_size, reverse=True)
+
+        if processes:
+            from concurrent.futures import ProcessPoolExecutor
+            index = {id(x): i for i, x in enumerate(self.filelist)}
+            # split members between workers by compressed size
+            groups = [[] for _ in range(workers)]
+            loads = [0] * workers
+            for zipinfo in files:
+                i = loads.index(min(loads))
+                groups[i].append(index[id(zipinfo)])
+                loads[i] += zipinfo.compress_size
+            with ProcessPoolExecutor(workers) as pool:
+                futures = [pool.submit(_extract_members, self.filename,
+                                       self.encoding, self._index,
+                                       g, path, pwd or self.pwd)
+                           for g in groups if g]
+                for f in futures:
+                    f.result()
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(workers) as pool:
+                futures = [pool.submit(self._extract_member, zipinfo, path, pwd)
+                           for zipinfo in files]
+                for f in futures:
+                    f.result()
 
     def _extract_member(self, member, targetpath, pwd):
         """Extract the ZipInfo object 'member' to a physical
@@ -979,19 +1409,33 @@ class ZipFile:
 
         # Create all upper directories if necessary.
         upperdirs = os.path.dirname(targetpath)
-        if upperdirs and not os.path.exists(upperdirs):
-            os.makedirs(upperdirs)
+        if upperdirs:
+            os.makedirs(upperdirs, exist_ok=True)
 
         if member.filename[-1] == '/':
-            if not os.path.isdir(targetpath):
-                os.mkdir(targetpath)
+            os.makedirs(targetpath, exist_ok=True)
             return targetpath
 
         source = self.open(member, pwd=pwd)
-        target = open(targetpath, "wb")
-        shutil.copyfileobj(source, target)
-        source.close()
-        target.close()
+        try:
+            with open(targetpath, "wb") as target:
+                if member.file_size and hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(target.fileno(), 0, member.file_size)
+                    except OSError:
+                        # not supported by the filesystem
+                        pass
+                buf = bytearray(min(member.file_size, COPY_BUFSIZE) or 1)
+                mv = memoryview(buf)
+                while True:
+                    n = source.readinto(buf)
+                    if not n:
+                        break
+                    target.write(mv[:n])
+        finally:
+            source.close()
+            if not self._filePassed:
+                source.fileobj.close()
 
         return targetpath
 
@@ -1355,6 +1799,18 @@ class PyZipFile(ZipFile):
         return (fname, archivename)
 
 
+def _extract_members(filename, encoding, index, indices, path, pwd):
+    """Extract filelist[i] for i in indices from the archive filename;
+       used by ZipFile.extractall in worker processes.
+    """
+    zf = ZipFile(filename, encoding=encoding, lazy=True, index=index)
+    try:
+        for i in indices:
+            zf._extract_member(zf._getInfo(i), path, pwd)
+    finally:
+        zf.close()
+
+
 def main(args = None):
     import textwrap
     USAGE=textwrap.dedent("""\
@@ -1363,14 +1819,21 @@ def main(args = None):
             zipfile.py -t zipfile.zip        # Test if a zipfile is valid
             zipfile.py -e zipfile.zip target # Extract zipfile into target dir
             zipfile.py -c zipfile.zip src ... # Create zipfile from sources
+            zipfile.py -b [size]             # Benchmark ZipCrypto decryption
         """)
     if args is None:
         args = sys.argv[1:]
 
-    if not args or args[0] not in ('-l', '-c', '-e', '-t'):
+    if not args or args[0] not in ('-l', '-c', '-e', '-t', '-b'):
         print(USAGE)
         sys.exit(1)
 
+    if args[0] == '-b':
+        if len(args) > 2:
+            print(USAGE)
+            sys.exit(1)
+        benchmark_decrypt(*[int(x) for x in args[1:]])
+
     if args[0] == '-l':
         if len(args) != 2:
             print(USAGE)
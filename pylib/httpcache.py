@@ -0,0 +1,302 @@
+'''A private HTTP cache shared by the HTTP client wrappers
+
+Responses to GET requests are stored on disk according to their
+Cache-Control / Expires headers, revalidated with ETag / Last-Modified
+when stale, and evicted in LRU order when the total size exceeds
+max_size. The cache is keyed by URL only, i.e. Vary is not supported
+(responses with "Vary: *" aren't stored).
+
+The clients pass a fetch function doing the actual request, which takes
+extra headers and returns (url, status, headers, body), where url is the
+final one after redirection and body is already decoded.
+'''
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import (
+  Optional, List, Tuple, Dict, Callable, Awaitable,
+)
+
+from myutils import safe_overwrite
+
+logger = logging.getLogger(__name__)
+
+Headers = List[Tuple[str, str]]
+FetchResult = Tuple[str, int, Headers, bytes]
+
+# RFC 9111 heuristically cacheable status codes
+CACHEABLE_STATUS = {200, 203, 204, 206, 300, 301, 308, 404, 405, 410, 414, 501}
+# the body is stored decoded, and these are per-connection
+_DROP_HEADERS = {
+  'content-encoding', 'content-length', 'transfer-encoding',
+  'connection', 'keep-alive',
+}
+# upper limit of heuristic freshness from Last-Modified
+HEURISTIC_MAX = 86400
+
+def _get(headers: Headers, name: str) -> Optional[str]:
+  name = name.lower()
+  for k, v in headers:
+    if k.lower() == name:
+      return v
+  return None
+
+def _parse_date(s: Optional[str]) -> Optional[float]:
+  if not s:
+    return None
+  try:
+    return parsedate_to_datetime(s).timestamp()
+  except (TypeError, ValueError):
+    return None
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+  ret: Dict[str, Optional[str]] = {}
+  if not value:
+    return ret
+  for part in value.split(','):
+    name, eq, arg = part.strip().partition('=')
+    if name:
+      ret[name.lower()] = arg.strip('"') if eq else None
+  return ret
+
+def freshness_lifetime(headers: Headers, now: float) -> Optional[float]:
+  '''seconds a response stays fresh, or None if it mustn't be stored'''
+  cc = parse_cache_control(_get(headers, 'Cache-Control'))
+  if 'no-store' in cc or _get(headers, 'Vary') == '*':
+    return None
+  if 'no-cache' in cc:
+    return 0
+
+  try:
+    age = max(int(_get(headers, 'Age') or 0), 0)
+  except ValueError:
+    age = 0
+
+  if cc.get('max-age'):
+    try:
+      return max(int(cc['max-age']) - age, 0) # type: ignore
+    except ValueError:
+      return 0
+
+  date = _parse_date(_get(headers, 'Date')) or now
+  expires = _get(headers, 'Expires')
+  if expires is not None:
+    t = _parse_date(expires)
+    # invalid dates like "0" mean already expired
+    return max(t - date - age, 0) if t else 0
+
+  lm = _parse_date(_get(headers, 'Last-Modified'))
+  if lm:
+    return min(max(date - lm, 0) / 10, HEURISTIC_MAX)
+  return 0
+
+class CacheEntry:
+  def __init__(
+    self, url: str, status: int, headers: Headers, body: bytes,
+    fresh_until: float, hit: bool = False,
+  ) -> None:
+    self.url = url
+    self.status = status
+    self.headers = headers
+    self.body = body
+    self.fresh_until = fresh_until
+    # whether this is served from the cache (maybe after revalidation)
+    self.hit = hit
+
+  def is_fresh(self, now: Optional[float] = None) -> bool:
+    return (now or time.time()) < self.fresh_until
+
+  def validators(self) -> Dict[str, str]:
+    '''headers for a conditional request'''
+    ret = {}
+    etag = _get(self.headers, 'ETag')
+    if etag:
+      ret['If-None-Match'] = etag
+    lm = _get(self.headers, 'Last-Modified')
+    if lm:
+      ret['If-Modified-Since'] = lm
+    return ret
+
+  def __repr__(self) -> str:
+    return f'<CacheEntry {self.status} {self.url}>'
+
+class HttpCache:
+  def __init__(self, path: str, max_size: int = 256 * 1024 * 1024) -> None:
+    self.path = os.path.expanduser(path)
+    self.max_size = max_size
+    os.makedirs(self.path, exist_ok=True)
+    # file name -> size, least recently used first
+    self._index: OrderedDict[str, int] = OrderedDict()
+    self.size = 0
+    self._inflight: Dict[str, asyncio.Future] = {}
+    self.hits = self.misses = self.revalidated = 0
+    self._load_index()
+
+  def _load_index(self) -> None:
+    files = []
+    with os.scandir(self.path) as it:
+      for e in it:
+        if e.is_file() and not e.name.endswith('.tmp'):
+          st = e.stat()
+          files.append((st.st_mtime, e.name, st.st_size))
+    files.sort()
+    for _, name, size in files:
+      self._index[name] = size
+      self.size += size
+
+  def _name(self, url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+  def get(self, url: str) -> Optional[CacheEntry]:
+    name = self._name(url)
+    if name not in self._index:
+      return None
+    path = os.path.join(self.path, name)
+    try:
+      with open(path, 'rb') as f:
+        meta = json.loads(f.readline())
+        body = f.read()
+      # mtime keeps the LRU order across runs
+      os.utime(path)
+    except (OSError, ValueError):
+      self._forget(name)
+      return None
+    self._index.move_to_end(name)
+    return CacheEntry(
+      meta['url'], meta['status'], [tuple(x) for x in meta['headers']], # type: ignore
+      body, meta['fresh_until'], hit=True,
+    )
+
+  def put(self, url: str, entry: CacheEntry) -> None:
+    name = self._name(url)
+    meta = json.dumps({
+      'url': entry.url,
+      'status': entry.status,
+      'headers': entry.headers,
+      'fresh_until': entry.fresh_until,
+    }).encode()
+    data = meta + b'\n' + entry.body
+    try:
+      safe_overwrite(os.path.join(self.path, name), data, mode='wb')
+    except OSError:
+      logger.exception('failed to store %s in cache', url)
+      return
+    self._forget(name)
+    self._index[name] = len(data)
+    self.size += len(data)
+    self._evict()
+
+  def delete(self, url: str) -> None:
+    name = self._name(url)
+    if name in self._index:
+      self._forget(name)
+      try:
+        os.unlink(os.path.join(self.path, name))
+      except FileNotFoundError:
+        pass
+
+  def _forget(self, name: str) -> None:
+    size = self._index.pop(name, None)
+    if size is not None:
+      self.size -= size
+
+  def _evict(self) -> None:
+    while self.size > self.max_size and len(self._index) > 1:
+      name, size = self._index.popitem(last=False)
+      self.size -= size
+      try:
+        os.unlink(os.path.join(self.path, name))
+      except FileNotFoundError:
+        pass
+
+  def _update(
+    self, url: str, entry: Optional[CacheEntry], result: FetchResult,
+  ) -> CacheEntry:
+    '''take the result of a (maybe conditional) request into the cache'''
+    final_url, status, headers, body = result
+    headers = [(k, v) for k, v in headers if k.lower() not in _DROP_HEADERS]
+    now = time.time()
+
+    if status == 304 and entry is not None:
+      self.revalidated += 1
+      names = {k.lower() for k, _ in headers}
+      entry.headers = [
+        (k, v) for k, v in entry.headers if k.lower() not in names
+      ] + headers
+      lifetime = freshness_lifetime(entry.headers, now)
+      entry.fresh_until = now + (lifetime or 0)
+      if lifetime is None:
+        self.delete(url)
+      else:
+        self.put(url, entry)
+      return entry
+
+    self.misses += 1
+    entry = CacheEntry(final_url, status, headers, body, now)
+    lifetime = freshness_lifetime(headers, now)
+    if status in CACHEABLE_STATUS and lifetime is not None:
+      entry.fresh_until = now + lifetime
+      if lifetime > 0 or entry.validators():
+        self.put(url, entry)
+    return entry
+
+  def fetch_sync(
+    self, url: str, fetch: Callable[[Dict[str, str]], FetchResult],
+  ) -> CacheEntry:
+    '''get url through the cache, calling fetch when needed'''
+    entry = self.get(url)
+    if entry is not None and entry.is_fresh():
+      self.hits += 1
+      return entry
+    return self._update(
+      url, entry, fetch(entry.validators() if entry else {}))
+
+  async def fetch(
+    self, url: str,
+    fetch: Callable[[Dict[str, str]], Awaitable[FetchResult]],
+  ) -> CacheEntry:
+    '''get url through the cache, awaiting fetch when needed
+
+    Concurrent calls for the same url share one fetch.'''
+    entry = self.get(url)
+    if entry is not None and entry.is_fresh():
+      self.hits += 1
+      return entry
+
+    fut = self._inflight.get(url)
+    if fut is not None:
+      self.hits += 1
+      return await asyncio.shield(fut)
+
+    fut = self._inflight[url] = asyncio.get_running_loop().create_future()
+    try:
+      result = await fetch(entry.validators() if entry else {})
+      ret = self._update(url, entry, result)
+    except asyncio.CancelledError:
+      fut.cancel()
+      raise
+    except BaseException as e:
+      fut.set_exception(e)
+      # don't complain about it if nobody else was waiting
+      fut.exception()
+      raise
+    else:
+      fut.set_result(ret)
+    finally:
+      del self._inflight[url]
+    return ret
+
+  def stats(self) -> Dict[str, int]:
+    return {
+      'entries': len(self._index),
+      'size': self.size,
+      'hits': self.hits,
+      'misses': self.misses,
+      'revalidated': self.revalidated,
+    }
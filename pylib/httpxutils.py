@@ -1,11 +1,20 @@
 import os
 from http.cookiejar import MozillaCookieJar
-from urllib.parse import urljoin
-from typing import Optional
+from urllib.parse import urljoin, urlsplit
+from collections import OrderedDict
+from typing import Optional, Iterable, Any
 import asyncio
+import logging
+import time
 
 import httpx
 
+from tokenbucket import TokenBucket
+from stats import QuantileStat
+from httpcache import HttpCache
+
+logger = logging.getLogger(__name__)
+
 type Path = str | bytes | os.PathLike
 
 class ClientBase:
@@ -15,21 +24,59 @@ class ClientBase:
   auto_referer: bool = False
   baseurl: Optional[str] = None
   cookiefile: Optional[Path] = None
+  rate_limiter: Optional[TokenBucket] = None
+  # GET requests go through this cache if set
+  cache: Optional[HttpCache] = None
+  # only used when we create the session ourselves
+  limits: httpx.Limits = httpx.Limits(
+    max_connections=100,
+    max_keepalive_connections=20,
+    keepalive_expiry=30,
+  )
+  timeout: httpx.Timeout = httpx.Timeout(30, connect=10)
+  # max concurrent requests per host, 0 for unlimited
+  per_host: int = 0
+  # requests taking longer than this many seconds are logged as warnings
+  slow_request: float = 5
+  # keep response times for at most this many routes, least recently
+  # used ones are dropped
+  max_timings: int = 256
 
   def __init__(
     self, *,
     baseurl: Optional[str] = None,
     cookiefile: Optional[Path] = None,
     session: Optional[httpx.AsyncClient] = None,
+    rate_limiter: Optional[TokenBucket] = None,
+    limits: Optional[httpx.Limits] = None,
+    timeout: Optional[httpx.Timeout] = None,
+    per_host: Optional[int] = None,
+    cache: Optional[HttpCache] = None,
   ) -> None:
     if baseurl is not None:
       self.baseurl = baseurl
     self.session = session
     self.cookiefile = cookiefile
+    if rate_limiter is not None:
+      self.rate_limiter = rate_limiter
+    if limits is not None:
+      self.limits = limits
+    if timeout is not None:
+      self.timeout = timeout
+    if per_host is not None:
+      self.per_host = per_host
+    if cache is not None:
+      self.cache = cache
+    self._host_sems: dict[str, asyncio.Semaphore] = {}
+    # "METHOD host/path" (or the route given to request) -> response
+    # times in seconds
+    self.timings: OrderedDict[str, QuantileStat] = OrderedDict()
 
   async def async_init(self) -> None:
     if not self.session:
-      s = httpx.AsyncClient(http2=True)
+      s = httpx.AsyncClient(
+        http2=True, limits=self.limits, timeout=self.timeout,
+      )
       self.session = s
 
       if self.cookiefile:
@@ -43,8 +90,11 @@ class ClientBase:
       self.session.cookies.jar.save()
 
   async def request(
-    self, url: str, method: Optional[str] = None, **kwargs,
+    self, url: str, method: Optional[str] = None, *,
+    route: Optional[str] = None, **kwargs,
   ) -> httpx.Response:
+    '''route, e.g. "/repos/{repo}/issues", is used to group response
+    times instead of the path, for URLs with IDs in them'''
     if not self.session:
       await self.async_init()
 
@@ -69,16 +119,125 @@ class ClientBase:
       else:
         method = 'get'
 
-    response = await self.session.request(method, url, **kwargs) # type: ignore
+    if self.cache is not None and method.lower() == 'get':
+      response = await self._cached_request(url, route, **kwargs)
+    else:
+      response = await self._send(method, url, route, **kwargs)
     # url may have been changed due to redirection
     self.lasturl = str(response.url)
     return response
 
+  async def _send(
+    self, method: str, url: str, route: Optional[str] = None, **kwargs,
+  ) -> httpx.Response:
+    if self.rate_limiter is not None:
+      await self.rate_limiter.acquire()
+
+    u = urlsplit(url)
+    if self.per_host > 0:
+      sem = self._host_sems.get(u.netloc)
+      if sem is None:
+        sem = self._host_sems[u.netloc] = asyncio.Semaphore(self.per_host)
+      async with sem:
+        return await self._timed_request(method, url, u, route, **kwargs)
+    else:
+      return await self._timed_request(method, url, u, route, **kwargs)
+
+  async def _cached_request(
+    self, url: str, route: Optional[str] = None, **kwargs,
+  ) -> httpx.Response:
+    full = str(httpx.URL(url).copy_merge_params(kwargs.pop('params', None) or {}))
+    headers = kwargs.pop('headers', None) or {}
+
+    async def fetch(validators):
+      r = await self._send(
+        'get', full, route, headers={**headers, **validators}, **kwargs)
+      return str(r.url), r.status_code, r.headers.multi_items(), r.content
+
+    entry = await self.cache.fetch(full, fetch) # type: ignore
+    return httpx.Response(
+      entry.status, headers=entry.headers, content=entry.body,
+      request=httpx.Request('GET', entry.url),
+    )
+
+  async def _timed_request(
+    self, method, url, u, route, **kwargs,
+  ) -> httpx.Response:
+    t = time.monotonic()
+    response = await self.session.request(method, url, **kwargs) # type: ignore
+    elapsed = time.monotonic() - t
+
+    key = f'{method.upper()} {u.netloc}{route or u.path}'
+    timings = self.timings
+    st = timings.get(key)
+    if st is None:
+      st = timings[key] = QuantileStat()
+      while len(timings) > self.max_timings:
+        timings.popitem(last=False)
+    else:
+      timings.move_to_end(key)
+    st.add(elapsed)
+    if elapsed > self.slow_request:
+      logger.warning('slow request: %s %s took %.3fs', method.upper(), url, elapsed)
+    else:
+      logger.debug('%s %s: %d in %.3fs', method.upper(), url, response.status_code, elapsed)
+    return response
+
+  def timing_report(self) -> str:
+    '''response times of requested endpoints, slowest total first'''
+    items = sorted(
+      self.timings.items(), key=lambda x: x[1].sum, reverse=True)
+    return '\n'.join(
+      f'{key}: n={st.n}, {st}' for key, st in items
+    )
+
+  async def gather_requests(
+    self, requests: Iterable[str | tuple[str, dict[str, Any]]],
+    concurrency: int = 10, return_exceptions: bool = False,
+  ) -> list[Any]:
+    '''run many requests with at most concurrency of them at a time
+
+    Each request is a URL or a (url, kwargs) tuple for request(). The
+    responses are returned in the same order as requests. If
+    return_exceptions is true, failed requests get their exceptions
+    instead of the whole batch being aborted.'''
+    reqs = list(requests)
+    results: list[Any] = [None] * len(reqs)
+    it = iter(enumerate(reqs))
+
+    async def worker() -> None:
+      for i, req in it:
+        if isinstance(req, str):
+          url, kwargs = req, {}
+        else:
+          url, kwargs = req
+        try:
+          results[i] = await self.request(url, **kwargs)
+        except Exception as e:
+          if not return_exceptions:
+            raise
+          results[i] = e
+
+    workers = [
+      asyncio.create_task(worker())
+      for _ in range(min(concurrency, len(reqs)))
+    ]
+    try:
+      await asyncio.gather(*workers)
+    except BaseException:
+      for w in workers:
+        w.cancel()
+      raise
+    return results
+
 async def test() -> None:
   client = ClientBase(baseurl='https://www.baidu.com/', cookiefile='test')
   res = await client.request('/')
   res = await client.request('/404')
   print(res, client.lasturl)
+  res = await client.gather_requests(['/'] * 5 + ['/404'], concurrency=3)
+  print(res)
+  print(client.timing_report())
 
 if __name__ == '__main__':
   asyncio.run(test())
@@ -27,6 +27,10 @@
 import socket as _socket
 import time
 import struct
+import logging
+from collections import OrderedDict
+
+from stats import QuantileStat
 
 '''
 Utilities for ICMP socket.
@@ -40,6 +44,8 @@ BSD 3-Clause "New" or "Revised" License.
 ICMP_ECHO_REQUEST = 8
 _d_size = struct.calcsize('d')
 
+logger = logging.getLogger(__name__)
+
 def pack_packet(seq, payload):
   # Header is type (8), code (8), checksum (16), id (16), sequence (16)
   # The checksum is always recomputed by the kernel, and the id is the port number
@@ -120,12 +126,159 @@ async def amain(address):
       print()
       break
 
+class Target:
+  '''A ping target and its stats; RTTs in stat are in milliseconds'''
+  def __init__(self, host, address):
+    self.host = host
+    self.address = address
+    self.seq = 0
+    self.received = 0
+    self.lost = 0
+    self.stat = QuantileStat()
+
+  @property
+  def loss(self):
+    n = self.received + self.lost
+    return self.lost / n if n else 0.0
+
+  def summary(self):
+    s = '%d/%d received, %.0f%% loss' % (
+      self.received, self.received + self.lost, self.loss * 100)
+    if self.received:
+      s += ', rtt ' + str(self.stat)
+    return s
+
+  def __repr__(self):
+    return '<Target %s (%s): %s>' % (self.host, self.address, self.summary())
+
+class Pinger:
+  '''Ping many targets over one shared non-blocking ICMP socket
+
+  Each round sends one packet to every target, spread evenly across
+  interval. Replies are matched by (address, seq); packets not answered
+  within timeout count as lost. on_reply(target, seq, rtt) and
+  on_loss(target, seq) are called if given, with rtt in seconds.
+  '''
+  def __init__(self, hosts, *, interval=1, timeout=2, packetsize=56,
+               on_reply=None, on_loss=None):
+    self.targets = {}
+    for host in hosts:
+      address = _socket.gethostbyname(host)
+      self.targets.setdefault(address, Target(host, address))
+    self.interval = interval
+    self.timeout = timeout
+    self.packetsize = packetsize
+    self.on_reply = on_reply
+    self.on_loss = on_loss
+    # (address, seq) -> send time, in send order and thus deadline order
+    self._pending = OrderedDict()
+    self.sock = None
+
+  def _on_readable(self):
+    sock = self.sock
+    now = time.monotonic()
+    while True:
+      try:
+        packet, peer = sock.recvfrom(1024)
+      except BlockingIOError:
+        break
+      except OSError as e:
+        # e.g. ICMP errors delivered to the socket
+        logger.debug('recvfrom error: %r', e)
+        continue
+      seq, _ = parse_packet(packet)
+      key = peer[0], seq
+      sent = self._pending.pop(key, None)
+      if sent is None:
+        continue
+      target = self.targets[peer[0]]
+      rtt = now - sent
+      target.received += 1
+      target.stat.add(rtt * 1000)
+      if self.on_reply:
+        self.on_reply(target, seq, rtt)
+
+  def _expire(self, now):
+    pending = self._pending
+    deadline = now - self.timeout
+    while pending:
+      key, sent = next(iter(pending.items()))
+      if sent > deadline:
+        break
+      del pending[key]
+      target = self.targets[key[0]]
+      target.lost += 1
+      if self.on_loss:
+        self.on_loss(target, key[1])
+
+  def _send(self, target):
+    target.seq = seq = (target.seq + 1) & 0xffff
+    packet = pack_packet_with_time(seq, self.packetsize)
+    key = target.address, seq
+    self._pending.pop(key, None)
+    self._pending[key] = time.monotonic()
+    try:
+      self.sock.sendto(packet, (target.address, 0))
+    except OSError as e:
+      # it will be counted as lost when timed out
+      logger.debug('sendto %s failed: %r', target.address, e)
+
+  async def run(self, count=None):
+    '''ping for count rounds, or forever if None'''
+    import asyncio
+    loop = asyncio.get_running_loop()
+    self.sock = socket()
+    self.sock.setblocking(False)
+    loop.add_reader(self.sock, self._on_readable)
+    try:
+      start = time.monotonic()
+      rounds = 0
+      while count is None or rounds < count:
+        # targets may be added or removed between rounds
+        targets = list(self.targets.values())
+        round_start = start + rounds * self.interval
+        if not targets:
+          delay = round_start + self.interval - time.monotonic()
+          if delay > 0:
+            await asyncio.sleep(delay)
+          self._expire(time.monotonic())
+          rounds += 1
+          continue
+        step = self.interval / len(targets)
+        for i, target in enumerate(targets):
+          delay = round_start + i * step - time.monotonic()
+          if delay > 0:
+            await asyncio.sleep(delay)
+          self._expire(time.monotonic())
+          self._send(target)
+        rounds += 1
+
+      while self._pending:
+        await asyncio.sleep(0.05)
+        self._expire(time.monotonic())
+    finally:
+      loop.remove_reader(self.sock)
+      self.sock.close()
+      self.sock = None
+
+def ping_many(hosts, count=4, **kwargs):
+  '''ping hosts together count times; returns {host: Target}'''
+  import asyncio
+  p = Pinger(hosts, **kwargs)
+  asyncio.run(p.run(count))
+  return {t.host: t for t in p.targets.values()}
+
 def main():
   import sys
-  if len(sys.argv) != 2:
+  if len(sys.argv) < 2:
     sys.exit('where to ping?')
-  t = ping(sys.argv[1])
-  print('%9.3fms.' % (t * 1000))
+  if len(sys.argv) == 2:
+    t = ping(sys.argv[1])
+    print('%9.3fms.' % (t * 1000))
+    return
+
+  for host, t in ping_many(sys.argv[1:]).items():
+    print('%s: %s' % (host, t.summary()))
 
 if __name__ == '__main__':
   main()
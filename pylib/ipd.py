@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+'''
+A long-running IP location lookup service over a UNIX socket, backed by
+QQWry (IPv4) and IPDB (IPv6).
+
+The protocol is line based: the client sends one IP address per line and
+gets one line of location back for each, in the same order. Requests can
+be pipelined and batched freely; addresses that can't be resolved get an
+empty line.
+
+The server notices when a database file is replaced (e.g. by
+``QQWry.py -u`` via safe_overwrite) and switches to the new one.
+SIGHUP forces a reload.
+'''
+
+import os
+import sys
+import socket
+import signal
+import asyncio
+import logging
+import ipaddress
+from functools import lru_cache, partial
+from itertools import islice
+from typing import List, Iterable, Optional, Tuple
+
+import QQWry
+import ipdb
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = os.path.join(
+  os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'ipd.sock')
+
+def _lookup(Q, D, ip: str) -> str:
+  try:
+    addr = ipaddress.ip_address(ip)
+    if addr.version == 4:
+      if Q is None:
+        return ''
+      return ''.join(Q[str(addr)][2:])
+    else:
+      if D is None:
+        return ''
+      return ' '.join(D.lookup(addr).info).replace('\t', ' ').strip()
+  except (LookupError, ValueError):
+    # not found, or not a valid address
+    return ''
+  except Exception:
+    logger.exception('error looking up %r', ip)
+    return ''
+
+class Databases:
+  def __init__(
+    self, qqwry_file: str = QQWry.DataFileName,
+    ipdb_file: str = ipdb.DEFAULT_FILE_LOCATION,
+    cache_size: int = 65536,
+  ) -> None:
+    self.files = qqwry_file, ipdb_file
+    self.cache_size = cache_size
+    self._stats: Optional[Tuple] = None
+    self._dbs: Tuple = None, None
+    self.reload()
+
+  def _stat(self) -> Tuple:
+    ret = []
+    for file in self.files:
+      try:
+        st = os.stat(file)
+        ret.append((st.st_dev, st.st_ino, st.st_mtime_ns))
+      except OSError:
+        ret.append(None)
+    return tuple(ret)
+
+  def reload(self) -> None:
+    stats = self._stat()
+    qqwry_file, ipdb_file = self.files
+    try:
+      Q = QQWry.QQWry(qqwry_file)
+    except OSError as e:
+      logger.error('failed to open QQWry database: %r', e)
+      Q = None
+    try:
+      D = ipdb.IPDB(ipdb_file)
+    except (OSError, ipdb.DatabaseError) as e:
+      logger.error('failed to open IPDB database: %r', e)
+      D = None
+
+    # replace the lookup function (and its cache) in one go, so that
+    # requests never see a mix of old and new databases
+    self.lookup = lru_cache(self.cache_size)(partial(_lookup, Q, D))
+    self._stats = stats
+    old, self._dbs = self._dbs, (Q, D)
+    logger.info('databases loaded: %s, %s', Q and len(Q), D and D.count)
+    # lookups are synchronous, so nothing is using the old ones now
+    for db in old:
+      if db is not None:
+        db.close()
+
+  def check(self) -> None:
+    if self._stat() != self._stats:
+      logger.info('database files changed, reloading')
+      self.reload()
+
+async def _readline(reader) -> Optional[bytes]:
+  '''read a line, or return None for an over-long one, which is skipped'''
+  try:
+    return await reader.readuntil(b'\n')
+  except asyncio.IncompleteReadError as e:
+    return e.partial
+  except asyncio.LimitOverrunError as e:
+    consumed = e.consumed
+
+  while True:
+    await reader.readexactly(consumed)
+    try:
+      await reader.readuntil(b'\n')
+      return None
+    except asyncio.LimitOverrunError as e:
+      consumed = e.consumed
+
+async def _handle(dbs: Databases, reader, writer) -> None:
+  try:
+    while True:
+      line = await _readline(reader)
+      if line is None:
+        # still answer it, so that the client stays in step
+        writer.write(b'\n')
+        await writer.drain()
+        continue
+      if not line:
+        break
+      ip = line.decode('ascii', errors='replace').strip()
+      writer.write(dbs.lookup(ip).encode('utf-8') + b'\n')
+      await writer.drain()
+  except (ConnectionError, asyncio.IncompleteReadError):
+    pass
+  finally:
+    writer.close()
+
+async def _watch(dbs: Databases, interval: float) -> None:
+  while True:
+    await asyncio.sleep(interval)
+    dbs.check()
+
+def _remove_stale_socket(path: str) -> None:
+  '''remove the socket file left by a dead server
+
+  Raise RuntimeError if a server is still listening on it.'''
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+  except FileNotFoundError:
+    return
+  except ConnectionRefusedError:
+    try:
+      os.unlink(path)
+    except FileNotFoundError:
+      pass
+    return
+  finally:
+    sock.close()
+  raise RuntimeError(f'another server is listening on {path}')
+
+async def serve(
+  dbs: Databases, path: str = DEFAULT_SOCKET, check_interval: float = 10,
+) -> None:
+  _remove_stale_socket(path)
+
+  loop = asyncio.get_running_loop()
+  loop.add_signal_handler(signal.SIGHUP, dbs.reload)
+  server = await asyncio.start_unix_server(partial(_handle, dbs), path)
+  watcher = asyncio.create_task(_watch(dbs, check_interval))
+  logger.info('listening on %s', path)
+  try:
+    async with server:
+      await server.serve_forever()
+  finally:
+    watcher.cancel()
+
+class Client:
+  # keep each round trip well within the socket buffers so that neither
+  # side blocks writing while the other one is not reading
+  batch_size = 1000
+
+  def __init__(self, path: str = DEFAULT_SOCKET) -> None:
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.connect(path)
+    self.f = self.sock.makefile('rwb')
+
+  def close(self) -> None:
+    self.f.close()
+    self.sock.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def lookup_many(self, ips: Iterable[str]) -> List[str]:
+    '''look up ips; those that can't be IP addresses (non-ASCII or with
+    line breaks) get empty results without being sent'''
+    ret = []
+    it = iter(ips)
+    while True:
+      batch = list(islice(it, self.batch_size))
+      if not batch:
+        break
+      valid = [ip.isascii() and '\n' not in ip and '\r' not in ip
+               for ip in batch]
+      self.f.write(''.join(
+        ip + '\n' for ip, ok in zip(batch, valid) if ok).encode('ascii'))
+      self.f.flush()
+      for ok in valid:
+        if ok:
+          ret.append(self.f.readline().decode('utf-8').rstrip('\n'))
+        else:
+          ret.append('')
+    return ret
+
+  def lookup(self, ip: str) -> str:
+    return self.lookup_many([ip])[0]
+
+def _print_result(ip: str, loc: str) -> None:
+  # same as QQWry.py reading from stdin
+  if loc:
+    print(ip, loc)
+  else:
+    print(ip)
+
+def _lookup_stream(client: Client, f) -> None:
+  rest = b''
+  while True:
+    # read whatever is available, so results show up without waiting
+    # for a full batch
+    data = f.read1(65536)
+    if not data:
+      break
+    *lines, rest = (rest + data).split(b'\n')
+    ips = [l.decode('utf-8', errors='replace').strip() for l in lines]
+    ips = [ip for ip in ips if ip]
+    for ip, loc in zip(ips, client.lookup_many(ips)):
+      _print_result(ip, loc)
+    sys.stdout.flush()
+
+  ip = rest.decode('utf-8', errors='replace').strip()
+  if ip:
+    _print_result(ip, client.lookup(ip))
+
+def main():
+  import argparse
+  parser = argparse.ArgumentParser(description='IP地址归属地查询服务')
+  parser.add_argument('IP', nargs='*',
+                      help='要查询的IP，为“-”时从标准输入读取，每行一个')
+  parser.add_argument('-s', '--serve', action='store_true', default=False,
+                      help='作为服务端运行')
+  parser.add_argument('-S', '--socket', default=DEFAULT_SOCKET,
+                      help='UNIX 套接字路径')
+  parser.add_argument('--qqwry', default=QQWry.DataFileName,
+                      help='纯真IP数据库文件路径')
+  parser.add_argument('--ipdb', default=ipdb.DEFAULT_FILE_LOCATION,
+                      help='IPv6 数据库文件路径')
+  parser.add_argument('--cache-size', type=int, default=65536,
+                      help='查询结果缓存条数')
+  args = parser.parse_args()
+
+  if args.serve:
+    from nicelogger import enable_pretty_logging
+    enable_pretty_logging('INFO')
+    dbs = Databases(args.qqwry, args.ipdb, args.cache_size)
+    try:
+      asyncio.run(serve(dbs, args.socket))
+    except KeyboardInterrupt:
+      pass
+    except RuntimeError as e:
+      sys.exit(str(e))
+    return
+
+  ips = args.IP
+  with Client(args.socket) as client:
+    if ips == ['-']:
+      _lookup_stream(client, sys.stdin.buffer)
+    else:
+      for ip, loc in zip(ips, client.lookup_many(ips)):
+        _print_result(ip, loc)
+
+if __name__ == '__main__':
+  main()
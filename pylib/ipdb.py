@@ -9,10 +9,12 @@ License: GPLv3 or later
 '''
 
 import os
-from struct import unpack
+from struct import unpack, iter_unpack
 import mmap
 import ipaddress
-from typing import Tuple, List
+from array import array
+from bisect import bisect_right
+from typing import Tuple, List, Optional, Iterable, Union
 from collections import namedtuple
 import logging
 
@@ -56,6 +58,11 @@ class IPDB:
                      real_count, count)
     self.count = real_count
     self.address_segment_len = f[24] if f[4] != 1 else 2
+    self._index_ips: Optional[array] = None
+
+  def close(self):
+    self._index_ips = None
+    self.f.close()
 
   def lookup(self, ip):
     ip = ipaddress.ip_address(ip)
@@ -70,6 +77,95 @@ class IPDB:
 
     return self._search_record(needle)
 
+  def _load_index(self) -> array:
+    '''read all range starts of the index area into an array, once'''
+    if self._index_ips is None:
+      if self.ip_version == 4:
+        fmt, stride = '<L3s', 7
+      else:
+        fmt, stride = '<Q3s', 11
+      start = self.index_base_offset
+      end = start + stride * self.count
+      ips = array('Q')
+      ips.extend(ip for ip, _ in iter_unpack(fmt, self.f[start:end]))
+      self._index_ips = ips
+    return self._index_ips
+
+  def lookup_many(
+    self, ips: Iterable[Union[
+      int, bytes, str, ipaddress.IPv4Address, ipaddress.IPv6Address]], *,
+    version: Optional[int] = None,
+  ) -> List[Optional[IpInfo]]:
+    '''look up many addresses at once
+
+    Addresses can be ipaddress objects, strings, packed bytes (4 or 16
+    bytes) or integers (full 32 or 128 bits) of the given IP version,
+    which defaults to the database's. Results are returned in input
+    order, with None for addresses not found. Addresses of the other IP
+    version raise ValueError, as in lookup.'''
+    v4 = self.ip_version == 4
+    shift = 0 if v4 else 8 * 8
+    size = 4 if v4 else 16
+    if version is not None and version != self.ip_version:
+      raise ValueError('wrong IP address version, supported is %s'
+                       % self.ip_version)
+    needles = []
+    for ip in ips:
+      if isinstance(ip, bytes):
+        if len(ip) != size:
+          raise ValueError('wrong IP address version, supported is %s'
+                           % self.ip_version)
+        ip = int.from_bytes(ip, 'big')
+      elif isinstance(ip, int):
+        if not 0 <= ip < 1 << (8 * size):
+          raise ValueError('%d is not an IPv%d address'
+                           % (ip, self.ip_version))
+      else:
+        addr = ipaddress.ip_address(ip)
+        if addr.version != self.ip_version:
+          raise ValueError('wrong IP address version, supported is %s'
+                           % self.ip_version)
+        ip = int(addr)
+      needles.append(ip >> shift)
+    return self._search_many(needles)
+
+  def lookup_packed(self, data: bytes) -> List[Optional[IpInfo]]:
+    '''look up addresses packed back to back in network byte order
+
+    data holds 16-byte addresses for an IPv6 database, or 4-byte ones for
+    an IPv4 one.'''
+    if self.ip_version == 4:
+      fmt, size = '>L', 4
+    else:
+      fmt, size = '>Q8x', 16
+    if len(data) % size:
+      raise ValueError('data length %d is not a multiple of %d'
+                       % (len(data), size))
+    return self._search_many([ip for ip, in iter_unpack(fmt, data)])
+
+  def _search_many(self, needles: List[int]) -> List[Optional[IpInfo]]:
+    index_ips = self._load_index()
+    count = self.count
+    int_to_ip = self._int_to_ip
+    order = sorted(range(len(needles)), key=needles.__getitem__)
+
+    results: List[Optional[IpInfo]] = [None] * len(needles)
+    lo = 0
+    last_i = -1
+    info = None
+    for n in order:
+      i = bisect_right(index_ips, needles[n], lo) - 1
+      if i < 0:
+        continue
+      lo = i
+      if i != last_i:
+        _, offset = self._read_index(i)
+        end = int_to_ip(index_ips[i+1]) if i + 1 < count else None
+        info = IpInfo(int_to_ip(index_ips[i]), end, self._read_rec(offset))
+        last_i = i
+      results[n] = info
+    return results
+
   def _search_record(self, needle: int) -> IpInfo:
     lo = 0
     hi = self.count - 1
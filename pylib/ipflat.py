@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+'''
+A flat, fixed-stride, mmap-friendly IP database format compiled from
+QQWry.Dat or ipv6wry.db.
+
+Layout (native little-endian, every section 8-byte aligned):
+
+  header    magic, version, IP width (4 or 8 bytes), record count,
+            string count and section offsets
+  starts    sorted range starts, one unsigned int of IP width each
+  ends      inclusive range ends, same stride as starts
+  locs      uint32 index into the string table for each range
+  stroffs   uint32 offsets of the strings, nstrings + 1 entries
+  strdata   UTF-8 location strings, fields separated by NUL
+
+A lookup is one bisect over starts and one string table index. The file
+is opened read-only and shared, so several processes use a single copy
+in the page cache.
+
+License: GPLv3 or later
+'''
+
+import sys
+import mmap
+import socket
+import ipaddress
+from array import array
+from bisect import bisect_right
+from struct import Struct, unpack
+from typing import List, Union
+
+from ipdb import IpInfo, DatabaseError
+
+MAGIC = b'IPFL'
+VERSION = 1
+_header = Struct('<4sBB2xQQQQQQQ')
+_HEADER_SIZE = 64
+
+def _pad8(n: int) -> int:
+  return (n + 7) & ~7
+
+def _int_array(width: int) -> array:
+  return array('I' if width == 4 else 'Q')
+
+class _Builder:
+  def __init__(self, width: int) -> None:
+    self.width = width
+    self.starts = _int_array(width)
+    self.ends = _int_array(width)
+    self.locs = array('I')
+    self.strings: dict[str, int] = {}
+
+  def add(self, start: int, end: int, info: List[str]) -> None:
+    loc = '\x00'.join(info)
+    idx = self.strings.setdefault(loc, len(self.strings))
+    self.starts.append(start)
+    self.ends.append(end)
+    self.locs.append(idx)
+
+  def tobytes(self) -> bytes:
+    if sys.byteorder != 'little':
+      raise DatabaseError('only little-endian hosts are supported')
+
+    blobs = [s.encode('utf-8') for s in self.strings]
+    stroffs = array('I', [0])
+    for b in blobs:
+      stroffs.append(stroffs[-1] + len(b))
+
+    sections = [
+      self.starts.tobytes(), self.ends.tobytes(),
+      self.locs.tobytes(), stroffs.tobytes(), b''.join(blobs),
+    ]
+    offsets = []
+    pos = _HEADER_SIZE
+    for sec in sections:
+      offsets.append(pos)
+      pos = _pad8(pos + len(sec))
+
+    out = bytearray(pos)
+    out[:_header.size] = _header.pack(
+      MAGIC, VERSION, self.width,
+      len(self.starts), len(self.strings), *offsets,
+    )
+    for off, sec in zip(offsets, sections):
+      out[off:off+len(sec)] = sec
+    return bytes(out)
+
+def compile_qqwry(Q) -> bytes:
+  '''compile an opened QQWry.QQWry database'''
+  b = _Builder(4)
+  for i in range(len(Q)):
+    sip, eip, country, area = Q[i]
+    b.add(sip, eip, [country, area])
+  return b.tobytes()
+
+def compile_ipdb(D) -> bytes:
+  '''compile an opened ipdb.IPDB database'''
+  width = 4 if D.ip_version == 4 else 8
+  b = _Builder(width)
+  last_ip, offset = D._read_index(0)
+  for i in range(1, D.count):
+    ip, next_offset = D._read_index(i)
+    b.add(last_ip, ip - 1, D._read_rec(offset))
+    last_ip, offset = ip, next_offset
+  b.add(last_ip, (1 << width * 8) - 1, D._read_rec(offset))
+  return b.tobytes()
+
+class FlatDB:
+  def __init__(self, dbfile: str) -> None:
+    with open(dbfile, 'rb') as f:
+      self.f = m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (magic, version, width, count, nstrings,
+     starts_off, ends_off, locs_off, stroffs_off, strdata_off,
+    ) = _header.unpack_from(m)
+    if magic != MAGIC:
+      raise DatabaseError('bad magic')
+    if version != VERSION:
+      raise DatabaseError('unsupported version', version)
+    if width not in (4, 8):
+      raise DatabaseError('unsupported ip length', width)
+    if sys.byteorder != 'little':
+      raise DatabaseError('only little-endian hosts are supported')
+
+    self.count = count
+    self.ip_version = 4 if width == 4 else 6
+    code = 'I' if width == 4 else 'Q'
+    view = memoryview(m)
+    self._starts = view[starts_off:starts_off+count*width].cast(code)
+    self._ends = view[ends_off:ends_off+count*width].cast(code)
+    self._locs = view[locs_off:locs_off+count*4].cast('I')
+    self._stroffs = view[stroffs_off:stroffs_off+(nstrings+1)*4].cast('I')
+    self._strdata_off = strdata_off
+
+  def close(self) -> None:
+    for v in (self._starts, self._ends, self._locs, self._stroffs):
+      v.release()
+    self.f.close()
+
+  def __len__(self) -> int:
+    return self.count
+
+  def __str__(self) -> str:
+    last = self._location(self._locs[self.count - 1])
+    return '%s %d条数据' % (' '.join(last), self.count)
+
+  def _ip_to_int(self, ip: Union[str, int, ipaddress.IPv4Address, ipaddress.IPv6Address]) -> int:
+    if isinstance(ip, int):
+      return ip
+    if self.ip_version == 4:
+      if not isinstance(ip, str):
+        ip = str(ip)
+      return unpack('>L', socket.inet_aton(ip))[0]
+    else:
+      return int(ipaddress.IPv6Address(ip)) >> 8 * 8
+
+  def _int_to_ip(self, i: int) -> Union[ipaddress.IPv4Address, ipaddress.IPv6Address]:
+    if self.ip_version == 4:
+      return ipaddress.IPv4Address(i)
+    else:
+      return ipaddress.IPv6Address(i << 8 * 8)
+
+  def _location(self, n: int) -> List[str]:
+    start = self._strdata_off + self._stroffs[n]
+    end = self._strdata_off + self._stroffs[n+1]
+    return self.f[start:end].decode('utf-8').split('\x00')
+
+  def lookup(self, ip) -> IpInfo:
+    '''look up an IP address in string, ipaddress or integer form
+
+    Integers are in database width, i.e. IPv6 addresses are the upper
+    64 bits.'''
+    needle = self._ip_to_int(ip)
+    i = bisect_right(self._starts, needle) - 1
+    if i < 0 or needle > self._ends[i]:
+      raise LookupError('IP not found')
+    return IpInfo(
+      self._int_to_ip(self._starts[i]),
+      self._int_to_ip(self._ends[i]),
+      self._location(self._locs[i]),
+    )
+
+  def iter(self):
+    for i in range(self.count):
+      yield IpInfo(
+        self._int_to_ip(self._starts[i]),
+        self._int_to_ip(self._ends[i]),
+        self._location(self._locs[i]),
+      )
+
+def main():
+  import argparse
+  from myutils import safe_overwrite
+
+  parser = argparse.ArgumentParser(description='编译及查询扁平格式的IP数据库')
+  parser.add_argument('-f', '--file', required=True,
+                      help='编译后的数据库文件路径')
+  parser.add_argument('-c', '--compile', choices=['qqwry', 'ipdb'],
+                      help='从指定格式的数据库编译')
+  parser.add_argument('-s', '--source',
+                      help='要编译的原数据库文件路径，默认为该格式的默认位置')
+  parser.add_argument('IP', nargs='*',
+                      help='要查询的IP')
+  args = parser.parse_args()
+
+  if args.compile == 'qqwry':
+    import QQWry
+    data = compile_qqwry(QQWry.QQWry(args.source or QQWry.DataFileName))
+  elif args.compile == 'ipdb':
+    import ipdb
+    data = compile_ipdb(ipdb.IPDB(args.source or ipdb.DEFAULT_FILE_LOCATION))
+  else:
+    data = None
+
+  if data is not None:
+    safe_overwrite(args.file, data, mode='wb')
+    if not args.IP:
+      return
+
+  D = FlatDB(args.file)
+  ips = args.IP
+  if not ips:
+    print(D)
+  elif len(ips) == 1:
+    print(' '.join(D.lookup(ips[0]).info))
+  else:
+    for ip in ips:
+      print(D.lookup(ip))
+
+if __name__ == '__main__':
+  main()
@@ -1,27 +1,125 @@
 import os
+import ipaddress
+from collections import OrderedDict
+from typing import Iterable, List, Optional
 
-from QQWry import QQWry
-import ipdb
-import geoip2
-
-Q = QQWry()
-D = ipdb.IPDB(ipdb.DEFAULT_FILE_LOCATION)
-if os.path.exists("/var/lib/GeoIP/GeoLite2-City.mmdb"):
-  G = geoip2.GeoIP2(
-    "/var/lib/GeoIP/GeoLite2-City.mmdb",
-    "/var/lib/GeoIP/GeoLite2-ASN.mmdb",
-  )
-else:
-  G = geoip2.GeoIP2(
-    "~/etc/data/GeoLite2-City.mmdb",
-    "~/etc/data/GeoLite2-ASN.mmdb",
-  )
+# databases are opened on first use; they are also available as the
+# module attributes Q, D and G
+_Q = None
+_D = None
+_G = None
+
+def _qqwry():
+  global _Q
+  if _Q is None:
+    from QQWry import QQWry
+    _Q = QQWry()
+  return _Q
+
+def _ipdb():
+  global _D
+  if _D is None:
+    import ipdb
+    _D = ipdb.IPDB(ipdb.DEFAULT_FILE_LOCATION)
+  return _D
+
+def _geoip():
+  global _G
+  if _G is None:
+    import geoip2
+    if os.path.exists("/var/lib/GeoIP/GeoLite2-City.mmdb"):
+      _G = geoip2.GeoIP2(
+        "/var/lib/GeoIP/GeoLite2-City.mmdb",
+        "/var/lib/GeoIP/GeoLite2-ASN.mmdb",
+      )
+    else:
+      _G = geoip2.GeoIP2(
+        "~/etc/data/GeoLite2-City.mmdb",
+        "~/etc/data/GeoLite2-ASN.mmdb",
+      )
+  return _G
+
+def __getattr__(name):
+  if name == 'Q':
+    return _qqwry()
+  elif name == 'D':
+    return _ipdb()
+  elif name == 'G':
+    return _geoip()
+  raise AttributeError(name)
 
 def lookupip(ip):
-  gi = G.lookup(ip)
+  gi = _geoip().lookup(ip)
   if gi.country_code != 'CN':
     return gi.display
   if '.' in ip:
-    return ''.join(Q[ip][2:])
+    return ''.join(_qqwry()[ip][2:])
+  else:
+    return ' '.join(_ipdb().lookup(ip).info).replace('\t', ' ')
+
+# network prefix -> whether it's in China, i.e. to be looked up in QQWry
+# or IPDB instead of GeoIP
+_routes: OrderedDict = OrderedDict()
+ROUTE_CACHE_SIZE = 65536
+
+def _prefix_of(addr: int, version: int):
+  '''the /24 or /48 network of addr'''
+  if version == 4:
+    return 4, addr >> 8
   else:
-    return ' '.join(D.lookup(ip).info).replace('\t', ' ')
+    return 6, addr >> 80
+
+def lookupip_many(ips: Iterable[str]) -> List[Optional[str]]:
+  '''lookupip for many IPs, with None for invalid or unknown ones
+
+  Whether an IP is in China is remembered for its /24 or /48 network, so
+  further IPs from there go straight to QQWry or IPDB, and addresses for
+  each of them are looked up in one batch. Other addresses are looked up
+  in GeoIP, once for each distinct address.'''
+  ips = list(ips)
+  results: List[Optional[str]] = [None] * len(ips)
+  v4 = []
+  v6 = []
+  addrs: List = [None] * len(ips)
+  geo = {}
+  for i, ip in enumerate(ips):
+    try:
+      addr = ipaddress.ip_address(ip)
+    except ValueError:
+      continue
+    addrs[i] = addr
+    key = _prefix_of(int(addr), addr.version)
+    cn = _routes.get(key)
+    if cn is None:
+      gi = _geoip().lookup(ip)
+      cn = gi.country_code == 'CN'
+      _routes[key] = cn
+      if len(_routes) > ROUTE_CACHE_SIZE:
+        _routes.popitem(last=False)
+      if not cn:
+        geo[addr] = gi.display
+    else:
+      _routes.move_to_end(key)
+
+    if not cn:
+      display = geo.get(addr)
+      if display is None:
+        display = geo[addr] = _geoip().lookup(ip).display
+      results[i] = display
+    elif addr.version == 4:
+      v4.append(i)
+    else:
+      v6.append(i)
+
+  if v4:
+    infos = _qqwry().lookup_many([int(addrs[i]) for i in v4])
+    for i, info in zip(v4, infos):
+      if info is not None:
+        results[i] = ''.join(info[2:])
+  if v6:
+    infos = _ipdb().lookup_many([addrs[i] for i in v6])
+    for i, info in zip(v6, infos):
+      if info is not None:
+        results[i] = ' '.join(info.info).replace('\t', ' ')
+
+  return results
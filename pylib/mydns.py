@@ -5,8 +5,11 @@
 @author: shell.xu
 @modified: lilydjwg
 '''
-import sys, struct, random, logging, io
+import sys, struct, random, logging
 import socket
+import asyncio
+
+from expiringdict import ExpiringDict
 
 logger = logging.getLogger('dns')
 
@@ -78,15 +81,15 @@ def packflag(qr, opcode, auth, truncated, rd, ra, rcode):
   return r
 
 def unpackflag(r):
-  r, qr = unpack(r, 1)
-  r, opcode = unpack(r, 4)
-  r, auth = unpack(r, 1)
-  r, truncated = unpack(r, 1)
-  r, rd = unpack(r, 1)
-  r, ra = unpack(r, 1)
-  r, rv = unpack(r, 3)
-  r, rcode = unpack(r, 4)
-  assert rv == 0
+  rcode, r = unpack(r, 4)
+  # the Z bits, including AD and CD from RFC 4035; ignored
+  _, r = unpack(r, 3)
+  ra, r = unpack(r, 1)
+  rd, r = unpack(r, 1)
+  truncated, r = unpack(r, 1)
+  auth, r = unpack(r, 1)
+  opcode, r = unpack(r, 4)
+  qr, r = unpack(r, 1)
   return qr, opcode, auth, truncated, rd, ra, rcode
 
 class Record(object):
@@ -109,68 +112,168 @@ class Record(object):
   def filteredRR(self, RRs, types): return (i for i in RRs if i[0] in types)
 
   def packname(self, name):
-    return b''.join(bytes((len(i),))+i for i in name.encode('ascii').split(b'.')) + b'\x00'
+    buf = bytearray()
+    self._packname(buf, name, None)
+    return bytes(buf)
 
-  def unpackname(self, s):
-    return self._unpackname(s).decode('ascii')
+  def _packname(self, buf, name, names):
+    '''append name to buf, compressed against names if given
 
-  def _unpackname(self, s):
-    r = []
-    c = ord(s.read(1))
-    while c != 0:
-      if c & 0xC0 == 0xC0:
-        c = (c << 8) + ord(s.read(1)) & 0x3FFF
-        r.append(self._unpackname(io.BytesIO(self.buf[c:])))
+    names maps name suffixes to their offsets in buf.'''
+    name = name.rstrip('.')
+    labels = name.split('.') if name else []
+    for i, label in enumerate(labels):
+      if names is not None:
+        suffix = '.'.join(labels[i:])
+        off = names.get(suffix)
+        if off is not None:
+          buf += struct.pack('>H', 0xC000 | off)
+          return
+        if len(buf) < 0x4000:
+          names[suffix] = len(buf)
+      label = label.encode('ascii')
+      buf.append(len(label))
+      buf += label
+    buf.append(0)
+
+  def unpackname(self, pos):
+    buf = self.buf
+    c = buf[pos]
+    if c & 0xC0 == 0xC0:
+      # fast path for a name that is just a pointer to a known one
+      hit = self._names.get((c << 8 | buf[pos+1]) & 0x3FFF)
+      if hit is not None:
+        return hit[0], pos + 2
+    return self._unpackname(pos)
+
+  def _unpackname(self, pos):
+    '''decode the name at pos, returning it and the position after it
+
+    Every suffix decoded is remembered by its offset, so names pointing
+    to the same places in the packet are only decoded once.'''
+    buf = self.buf
+    cache = self._names
+    labels = []
+    # (offset, index into labels, index into seg_ends) of each label
+    starts = []
+    # where each run of labels ends in place, i.e. after the terminating
+    # zero or the compression pointer
+    seg_ends = []
+    for _ in range(len(buf)):
+      hit = cache.get(pos)
+      if hit is not None:
+        suffix, end = hit
+        if suffix:
+          labels.append(suffix)
+        seg_ends.append(end)
         break
-      else: r.append(s.read(c))
-      c = ord(s.read(1))
-    return b'.'.join(r)
+      c = buf[pos]
+      if c == 0:
+        seg_ends.append(pos + 1)
+        break
+      elif c & 0xC0 == 0xC0:
+        seg_ends.append(pos + 2)
+        pos = (c << 8 | buf[pos+1]) & 0x3FFF
+      else:
+        starts.append((pos, len(labels), len(seg_ends)))
+        labels.append(buf[pos+1:pos+1+c].decode('ascii'))
+        pos += 1 + c
+    else:
+      raise ValueError('compression pointer loop')
+
+    for p, i, seg in starts:
+      cache[p] = '.'.join(labels[i:]), seg_ends[seg]
+    return '.'.join(labels), seg_ends[0]
+
+  def _packquiz(self, buf, names, name, qtype, cls):
+    self._packname(buf, name, names)
+    buf += struct.pack('>HH', qtype, cls)
 
   def packquiz(self, name, qtype, cls):
-    return self.packname(name) + struct.pack('>HH', qtype, cls)
+    buf = bytearray()
+    self._packquiz(buf, None, name, qtype, cls)
+    return bytes(buf)
 
-  def unpackquiz(self, s):
-    name, r = self.unpackname(s), struct.unpack('>HH', s.read(4))
-    return name, r[0], r[1]
+  def unpackquiz(self, pos):
+    name, pos = self.unpackname(pos)
+    qtype, cls = struct.unpack_from('>HH', self.buf, pos)
+    return (name, qtype, cls), pos + 4
 
-  def read_string(self, s, length):
-    consumed = 0
+  def read_string(self, pos, length):
+    buf = self.buf
+    end = pos + length
     r = []
-    while consumed < length:
-      new_len = s.read(1)[0]
-      r.append(s.read(new_len))
-      consumed += new_len + 1
+    while pos < end:
+      n = buf[pos]
+      r.append(buf[pos+1:pos+1+n])
+      pos += n + 1
     return b''.join(r)
 
   def showquiz(self, q):
     return '\t%s\t%s\t%s' % (q[0], TYPE.lookup(q[1]), CLASS.lookup(q[2]))
 
-  # def packRR(self, name, type, cls, ttl, res):
-  #   return self.packname(name) + \
-  #     struct.pack('>HHIH', type, cls, ttl, len(res)) + res
-
-  def unpackRR(self, s):
-    n = self.unpackname(s)
-    r = struct.unpack('>HHIH', s.read(10))
-    if r[0] == TYPE.A:
-      return n, r[0], r[1], r[2], socket.inet_ntoa(s.read(r[3]))
-    elif r[0] == TYPE.CNAME:
-      return n, r[0], r[1], r[2], self.unpackname(s)
-    elif r[0] == TYPE.MX:
-      return n, r[0], r[1], r[2], \
-        struct.unpack('>H', s.read(2))[0], self.unpackname(s)
-    elif r[0] == TYPE.PTR:
-      return n, r[0], r[1], r[2], self.unpackname(s)
-    elif r[0] == TYPE.SOA:
-      rr = [n, r[0], r[1], r[2], self.unpackname(s), self.unpackname(s)]
-      rr.extend(struct.unpack('>IIIII', s.read(20)))
-      return tuple(rr)
-    elif r[0] == TYPE.TXT:
-      return n, r[0], r[1], r[2], self.read_string(s, r[3])
-    else: raise Exception("don't know howto handle type, %s." % str(r))
+  def _packRR(self, buf, names, name, type, cls, ttl, *rdata):
+    self._packname(buf, name, names)
+    buf += struct.pack('>HHIH', type, cls, ttl, 0)
+    start = len(buf)
+    if type == TYPE.A:
+      buf += socket.inet_aton(rdata[0])
+    elif type == TYPE.AAAA:
+      buf += socket.inet_pton(socket.AF_INET6, rdata[0])
+    elif type in (TYPE.CNAME, TYPE.PTR, TYPE.NS):
+      self._packname(buf, rdata[0], names)
+    elif type == TYPE.MX:
+      buf += struct.pack('>H', rdata[0])
+      self._packname(buf, rdata[1], names)
+    elif type == TYPE.SOA:
+      self._packname(buf, rdata[0], names)
+      self._packname(buf, rdata[1], names)
+      buf += struct.pack('>IIIII', *rdata[2:])
+    elif type == TYPE.TXT:
+      data = rdata[0]
+      for i in range(0, len(data), 255):
+        chunk = data[i:i+255]
+        buf.append(len(chunk))
+        buf += chunk
+      if not data:
+        buf.append(0)
+    elif isinstance(rdata[0], (bytes, bytearray)):
+      buf += rdata[0]
+    else: raise Exception("don't know howto handle type, %s." % type)
+    struct.pack_into('>H', buf, start - 2, len(buf) - start)
+
+  def packRR(self, name, type, cls, ttl, *rdata):
+    buf = bytearray()
+    self._packRR(buf, None, name, type, cls, ttl, *rdata)
+    return bytes(buf)
+
+  def unpackRR(self, pos):
+    n, pos = self.unpackname(pos)
+    type, cls, ttl, length = struct.unpack_from('>HHIH', self.buf, pos)
+    pos += 10
+    end = pos + length
+    if type == TYPE.A:
+      rr = n, type, cls, ttl, socket.inet_ntoa(self.buf[pos:end])
+    elif type == TYPE.AAAA:
+      rr = n, type, cls, ttl, socket.inet_ntop(socket.AF_INET6, self.buf[pos:end])
+    elif type in (TYPE.CNAME, TYPE.PTR, TYPE.NS):
+      rr = n, type, cls, ttl, self.unpackname(pos)[0]
+    elif type == TYPE.MX:
+      pref = struct.unpack_from('>H', self.buf, pos)[0]
+      rr = n, type, cls, ttl, pref, self.unpackname(pos + 2)[0]
+    elif type == TYPE.SOA:
+      mname, p = self.unpackname(pos)
+      rname, p = self.unpackname(p)
+      rr = (n, type, cls, ttl, mname, rname) + struct.unpack_from('>IIIII', self.buf, p)
+    elif type == TYPE.TXT:
+      rr = n, type, cls, ttl, self.read_string(pos, length)
+    else:
+      # unknown types are kept as raw rdata
+      rr = n, type, cls, ttl, self.buf[pos:end]
+    return rr, end
 
   def showRR(self, r):
-    if r[1] in (TYPE.A, TYPE.CNAME, TYPE.PTR, TYPE.SOA):
+    if r[1] in (TYPE.A, TYPE.AAAA, TYPE.CNAME, TYPE.PTR, TYPE.NS, TYPE.SOA):
       return '\t%s\t%d\t%s\t%s\t%s' % (
         r[0], r[3], CLASS.lookup(r[2]), TYPE.lookup(r[1]), r[4])
     elif r[1] == TYPE.MX:
@@ -179,30 +282,36 @@ class Record(object):
     else: raise Exception("don't know howto handle type, %s." % str(r))
 
   def pack(self):
-    self.buf = struct.pack(
+    buf = bytearray(struct.pack(
       '>HHHHHH', self.id, packflag(self.qr, self.opcode, self.authans,
                      self.truncated, self.rd, self.ra, self.rcode),
-      len(self.quiz), len(self.ans), len(self.auth), len(self.ex))
-    for i in self.quiz: self.buf += self.packquiz(*i)
-    for i in self.ans: self.buf += self.packRR(*i)
-    for i in self.auth: self.buf += self.packRR(*i)
-    for i in self.ex: self.buf += self.packRR(*i)
+      len(self.quiz), len(self.ans), len(self.auth), len(self.ex)))
+    names = {}
+    for i in self.quiz: self._packquiz(buf, names, *i)
+    for i in self.ans: self._packRR(buf, names, *i)
+    for i in self.auth: self._packRR(buf, names, *i)
+    for i in self.ex: self._packRR(buf, names, *i)
+    self.buf = bytes(buf)
     return self.buf
 
   @classmethod
   def unpack(cls, dt):
-    s = io.BytesIO(dt)
-    id, flag, lquiz, lans, lauth, lex = struct.unpack('>HHHHHH', s.read(12))
+    id, flag, lquiz, lans, lauth, lex = struct.unpack_from('>HHHHHH', dt)
     rec = cls(id, *unpackflag(flag))
     rec.buf = dt
-    rec.quiz = [rec.unpackquiz(s) for i in range(lquiz)]
-    rec.ans = [rec.unpackRR(s) for i in range(lans)]
-    rec.auth = [rec.unpackRR(s) for i in range(lauth)]
-    rec.ex = [rec.unpackRR(s) for i in range(lex)]
+    rec._names = {}
+    pos = 12
+    for _ in range(lquiz):
+      q, pos = rec.unpackquiz(pos)
+      rec.quiz.append(q)
+    for l, n in ((rec.ans, lans), (rec.auth, lauth), (rec.ex, lex)):
+      for _ in range(n):
+        rr, pos = rec.unpackRR(pos)
+        l.append(rr)
     return rec
 
 def mkquery(*ntlist):
-  rec = Record(random.randint(0, 65536), 0, OPCODE.QUERY, 0, 0, 1, 0, 0)
+  rec = Record(random.randint(0, 65535), 0, OPCODE.QUERY, 0, 0, 1, 0, 0)
   for name, type in ntlist: rec.quiz.append((name, type, CLASS.IN))
   return rec
 
@@ -238,3 +347,145 @@ def query(name, type=TYPE.A, server='127.0.0.1', port=53, protocol='udp'):
 def nslookup(name):
   r = query(name)
   return [rdata for name, type, cls, ttl, rdata in r.ans if type == TYPE.A]
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+  def __init__(self, resolver):
+    self.resolver = resolver
+
+  def datagram_received(self, data, addr):
+    self.resolver._reply_received(self.resolver._udp_pending, data)
+
+  def error_received(self, exc):
+    logger.warning('UDP error: %r', exc)
+
+  def connection_lost(self, exc):
+    self.resolver._udp_lost(exc)
+
+class Resolver:
+  '''An asyncio DNS stub resolver
+
+  All queries share one UDP socket and are matched to replies by ID.
+  Truncated replies are retried over one persistent, pipelined TCP
+  connection. Answers are cached for their smallest TTL.
+  '''
+  def __init__(self, server='127.0.0.1', port=53, *,
+               timeout=5, cache_size=1024):
+    self.addr = server, port
+    self.timeout = timeout
+    self.cache = ExpiringDict(0, maxsize=cache_size)
+    self._inflight = {}
+    self._udp = None
+    self._udp_lock = asyncio.Lock()
+    self._udp_pending = {}
+    self._tcp = None
+    self._tcp_task = None
+    self._tcp_pending = {}
+    self._tcp_lock = asyncio.Lock()
+
+  def close(self):
+    if self._udp is not None:
+      self._udp.close()
+    if self._tcp is not None:
+      self._tcp[1].close()
+
+  def _new_query(self, pending, name, type):
+    while True:
+      rec = mkquery((name, type))
+      if rec.id not in pending:
+        return rec
+
+  def _reply_received(self, pending, data):
+    if len(data) < 12:
+      return
+    id = struct.unpack_from('>H', data)[0]
+    fu = pending.pop(id, None)
+    if fu is not None and not fu.done():
+      fu.set_result(data)
+
+  def _fail_all(self, pending, exc):
+    for fu in pending.values():
+      if not fu.done():
+        fu.set_exception(exc)
+    pending.clear()
+
+  def _udp_lost(self, exc):
+    self._udp = None
+    self._fail_all(self._udp_pending, exc or ConnectionError('socket closed'))
+
+  async def _wait(self, pending, id, fu):
+    try:
+      return await asyncio.wait_for(fu, self.timeout)
+    finally:
+      pending.pop(id, None)
+
+  async def _query_udp(self, name, type):
+    async with self._udp_lock:
+      if self._udp is None:
+        loop = asyncio.get_running_loop()
+        self._udp, _ = await loop.create_datagram_endpoint(
+          lambda: _UDPProtocol(self), remote_addr=self.addr)
+
+    pending = self._udp_pending
+    rec = self._new_query(pending, name, type)
+    fu = pending[rec.id] = asyncio.get_running_loop().create_future()
+    self._udp.sendto(rec.pack())
+    return await self._wait(pending, rec.id, fu)
+
+  async def _tcp_reader(self, reader, writer):
+    exc = ConnectionError('connection closed')
+    try:
+      while True:
+        d = await reader.readexactly(2)
+        reply = await reader.readexactly(struct.unpack('>H', d)[0])
+        self._reply_received(self._tcp_pending, reply)
+    except (asyncio.IncompleteReadError, ConnectionError) as e:
+      exc = ConnectionError(e)
+    finally:
+      if self._tcp is not None and self._tcp[1] is writer:
+        self._tcp = None
+      writer.close()
+      self._fail_all(self._tcp_pending, exc)
+
+  async def _query_tcp(self, name, type):
+    async with self._tcp_lock:
+      if self._tcp is None:
+        reader, writer = await asyncio.open_connection(*self.addr)
+        self._tcp = reader, writer
+        self._tcp_task = asyncio.create_task(self._tcp_reader(reader, writer))
+    _, writer = self._tcp
+
+    pending = self._tcp_pending
+    rec = self._new_query(pending, name, type)
+    fu = pending[rec.id] = asyncio.get_running_loop().create_future()
+    q = rec.pack()
+    writer.write(struct.pack('>H', len(q)) + q)
+    return await self._wait(pending, rec.id, fu)
+
+  async def _query(self, key):
+    name, type = key
+    r = Record.unpack(await self._query_udp(name, type))
+    if r.truncated:
+      r = Record.unpack(await self._query_tcp(name, type))
+
+    rrs = r.ans + r.auth
+    if rrs:
+      self.cache.set_item(key, r, ttl=min(rr[3] for rr in rrs))
+    return r
+
+  async def query(self, name, type=TYPE.A):
+    key = name.lower().rstrip('.'), type
+    try:
+      return self.cache[key]
+    except KeyError:
+      pass
+
+    # queries for the same name share one request
+    fu = self._inflight.get(key)
+    if fu is None:
+      fu = self._inflight[key] = asyncio.ensure_future(self._query(key))
+      fu.add_done_callback(lambda _: self._inflight.pop(key, None))
+    return await asyncio.shield(fu)
+
+  async def nslookup(self, name):
+    r = await self.query(name)
+    return [rdata for name, type, cls, ttl, rdata in r.ans if type == TYPE.A]
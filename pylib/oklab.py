@@ -1,4 +1,13 @@
-from math import cbrt, pi, cos, sin, pow
+from math import cbrt, pi, cos, sin, pow, sqrt
+from typing import Iterable, List, Sequence, Tuple
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+RGB = Tuple[int, int, int]
+Lab = Tuple[float, float, float]
 
 def oklab_to_rgb(L, a, b):
   l_ = L + 0.3963377774 * a + 0.2158037573 * b;
@@ -49,3 +58,228 @@ def gamma_inv(x):
     return pow((x + 0.055) / (1 + 0.055), 2.4)
   else:
     return x / 12.92
+
+# The sRGB transfer curve is looked up in tables: by 8-bit value for
+# decoding, and by linear value quantized to 16 bits for encoding, which
+# is fine enough for the steep part near black. Unlike oklab_to_rgb, the
+# batch functions clip out-of-gamut colors and round to nearest.
+
+_M_LINEAR_TO_LMS = (
+  (0.4121656120, 0.5362752080, 0.0514575653),
+  (0.2118591070, 0.6807189584, 0.1074065790),
+  (0.0883097947, 0.2818474174, 0.6302613616),
+)
+_M_LMS_TO_LAB = (
+  (0.2104542553, 0.7936177850, -0.0040720468),
+  (1.9779984951, -2.4285922050, 0.4505937099),
+  (0.0259040371, 0.7827717662, -0.8086757660),
+)
+_M_LAB_TO_LMS = (
+  (1.0, 0.3963377774, 0.2158037573),
+  (1.0, -0.1055613458, -0.0638541728),
+  (1.0, -0.0894841775, -1.2914855480),
+)
+_M_LMS_TO_LINEAR = (
+  (4.0767245293, -3.3072168827, 0.2307590544),
+  (-1.2681437731, 2.6093323231, -0.3411344290),
+  (-0.0041119885, -0.7034763098, 1.7068625689),
+)
+
+_ENCODE_STEPS = 65535
+_decode_table = [gamma_inv(i / 255) for i in range(256)]
+_encode_table = None
+_np_tables = None
+
+def _get_encode_table() -> bytes:
+  global _encode_table
+  if _encode_table is None:
+    _encode_table = bytes(
+      min(max(round(255 * gamma(i / _ENCODE_STEPS)), 0), 255)
+      for i in range(_ENCODE_STEPS + 1)
+    )
+  return _encode_table
+
+def _get_np_tables():
+  global _np_tables
+  if _np_tables is None:
+    _np_tables = (
+      np.array(_decode_table, dtype=np.float32),
+      np.frombuffer(_get_encode_table(), dtype=np.uint8),
+      np.array(_M_LINEAR_TO_LMS, dtype=np.float32).T,
+      np.array(_M_LMS_TO_LAB, dtype=np.float32).T,
+      np.array(_M_LAB_TO_LMS, dtype=np.float32).T,
+      np.array(_M_LMS_TO_LINEAR, dtype=np.float32).T,
+    )
+  return _np_tables
+
+def _encode(x: float) -> int:
+  '''linear value to 8-bit sRGB, clipped'''
+  if x <= 0:
+    return 0
+  if x >= 1:
+    return 255
+  return _get_encode_table()[int(x * _ENCODE_STEPS + 0.5)]
+
+def _check_buffer(buf):
+  mv = memoryview(buf).cast('B')
+  if len(mv) % 3:
+    raise ValueError('buffer length %d is not a multiple of 3' % len(mv))
+  return mv
+
+def rgb_to_oklab_array(rgb):
+  '''convert an array of shape (..., 3) of 8-bit sRGB, or a packed RGB
+  buffer, to a float32 array of OKLab values in the same shape (or
+  (N, 3) for a buffer). NumPy is required.
+
+  Arrays must be of an integer type with values in 0..255; float images
+  should be scaled first, e.g. (img * 255).round().astype(np.uint8).'''
+  decode, _, to_lms, to_lab, _, _ = _get_np_tables()
+  if not isinstance(rgb, np.ndarray):
+    rgb = np.frombuffer(_check_buffer(rgb), dtype=np.uint8).reshape(-1, 3)
+  elif rgb.dtype != np.uint8:
+    if not np.issubdtype(rgb.dtype, np.integer):
+      raise TypeError('expected 8-bit RGB values, got dtype %s' % rgb.dtype)
+    if rgb.size and (rgb.min() < 0 or rgb.max() > 255):
+      raise ValueError('RGB values out of range 0..255')
+    rgb = rgb.astype(np.uint8)
+  lms = decode[rgb] @ to_lms
+  np.cbrt(lms, out=lms)
+  return lms @ to_lab
+
+def oklab_to_rgb_array(lab):
+  '''convert an array of shape (..., 3) of OKLab values to a uint8 sRGB
+  array of the same shape; use .tobytes() to get a packed buffer.
+  NumPy is required.'''
+  _, encode, _, _, to_lms, to_linear = _get_np_tables()
+  lms = np.asarray(lab, dtype=np.float32) @ to_lms
+  lms *= lms * lms
+  linear = lms @ to_linear
+  np.clip(linear, 0, 1, out=linear)
+  linear *= _ENCODE_STEPS
+  linear += 0.5
+  return encode[linear.astype(np.uint16)]
+
+def rgb_to_oklab_many(buf: bytes) -> List[Lab]:
+  '''convert a packed RGB buffer to a list of (L, a, b)
+
+  NumPy is used if available.'''
+  if np is not None:
+    return [tuple(x) for x in rgb_to_oklab_array(buf).tolist()]
+
+  decode = _decode_table
+  (m00, m01, m02), (m10, m11, m12), (m20, m21, m22) = _M_LINEAR_TO_LMS
+  (n00, n01, n02), (n10, n11, n12), (n20, n21, n22) = _M_LMS_TO_LAB
+  ret = []
+  append = ret.append
+  cache = {}
+  mv = _check_buffer(buf)
+  for i in range(0, len(mv), 3):
+    key = bytes(mv[i:i+3])
+    lab = cache.get(key)
+    if lab is None:
+      r = decode[key[0]]
+      g = decode[key[1]]
+      b = decode[key[2]]
+      l_ = cbrt(m00 * r + m01 * g + m02 * b)
+      m_ = cbrt(m10 * r + m11 * g + m12 * b)
+      s_ = cbrt(m20 * r + m21 * g + m22 * b)
+      lab = cache[key] = (
+        n00 * l_ + n01 * m_ + n02 * s_,
+        n10 * l_ + n11 * m_ + n12 * s_,
+        n20 * l_ + n21 * m_ + n22 * s_,
+      )
+    append(lab)
+  return ret
+
+def oklab_to_rgb_many(labs: Iterable[Lab]) -> bytes:
+  '''convert (L, a, b) values to a packed RGB buffer
+
+  NumPy is used if available.'''
+  if np is not None:
+    lab = np.array(list(labs), dtype=np.float32).reshape(-1, 3)
+    return oklab_to_rgb_array(lab).tobytes()
+
+  (m00, m01, m02), (m10, m11, m12), (m20, m21, m22) = _M_LAB_TO_LMS
+  (n00, n01, n02), (n10, n11, n12), (n20, n21, n22) = _M_LMS_TO_LINEAR
+  encode = _encode
+  ret = bytearray()
+  extend = ret.extend
+  for L, a, b in labs:
+    l = (m00 * L + m01 * a + m02 * b) ** 3
+    m = (m10 * L + m11 * a + m12 * b) ** 3
+    s = (m20 * L + m21 * a + m22 * b) ** 3
+    extend((
+      encode(n00 * l + n01 * m + n02 * s),
+      encode(n10 * l + n11 * m + n12 * s),
+      encode(n20 * l + n21 * m + n22 * s),
+    ))
+  return bytes(ret)
+
+def _oklab_to_linear(L, a, b):
+  l = (L + 0.3963377774 * a + 0.2158037573 * b) ** 3
+  m = (L - 0.1055613458 * a - 0.0638541728 * b) ** 3
+  s = (L - 0.0894841775 * a - 1.2914855480 * b) ** 3
+  return (
+    +4.0767245293 * l - 3.3072168827 * m + 0.2307590544 * s,
+    -1.2681437731 * l + 2.6093323231 * m - 0.3411344290 * s,
+    -0.0041119885 * l - 0.7034763098 * m + 1.7068625689 * s,
+  )
+
+def _in_gamut(L, a, b, eps=1e-6):
+  return all(-eps <= x <= 1 + eps for x in _oklab_to_linear(L, a, b))
+
+def _to_rgb(L, a, b) -> RGB:
+  r, g, b = _oklab_to_linear(L, a, b)
+  return _encode(r), _encode(g), _encode(b)
+
+def gradient(stops: Sequence[RGB], n: int) -> List[RGB]:
+  '''n colors going through the RGB colors in stops, interpolated in
+  OKLab and evenly spaced by perceptual distance, so that no segment of
+  the gradient looks stretched or squeezed'''
+  if not stops:
+    raise ValueError('no color stops given')
+  labs = [rgb_to_oklab(*c) for c in stops]
+  if n == 1 or len(labs) == 1:
+    return [_to_rgb(*labs[0])] * n
+
+  pos = [0.0]
+  for p, q in zip(labs, labs[1:]):
+    pos.append(pos[-1] + sqrt(sum((x - y) ** 2 for x, y in zip(p, q))))
+  total = pos[-1]
+  if total == 0:
+    return [_to_rgb(*labs[0])] * n
+
+  ret = []
+  seg = 0
+  for i in range(n):
+    d = total * i / (n - 1)
+    while seg < len(labs) - 2 and d > pos[seg + 1]:
+      seg += 1
+    span = pos[seg + 1] - pos[seg]
+    t = (d - pos[seg]) / span if span else 0
+    p, q = labs[seg], labs[seg + 1]
+    ret.append(_to_rgb(*(x + (y - x) * t for x, y in zip(p, q))))
+  return ret
+
+def palette(n: int, L: float = 0.75, C: float = 0.12, h: float = 0.0) -> List[RGB]:
+  '''n colors of the same lightness L with evenly spaced hues, starting
+  from hue h (in turns, as in oklch_to_rgb)
+
+  The chroma C is lowered for hues where it'd fall out of the sRGB
+  gamut.'''
+  ret = []
+  for i in range(n):
+    hue = 2 * pi * (h + i / n)
+    ca, sa = cos(hue), sin(hue)
+    c = C
+    if not _in_gamut(L, c * ca, c * sa):
+      lo, hi = 0.0, C
+      for _ in range(20):
+        c = (lo + hi) / 2
+        if _in_gamut(L, c * ca, c * sa):
+          lo = c
+        else:
+          hi = c
+      c = lo
+    ret.append(_to_rgb(L, c * ca, c * sa))
+  return ret
@@ -1,9 +1,14 @@
 import os
+import io
 from http.cookiejar import MozillaCookieJar
 from urllib.parse import urljoin
 from typing import Optional, BinaryIO
 
 import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from httpcache import HttpCache, CacheEntry
 
 CHUNK_SIZE = 40960
 
@@ -30,6 +35,24 @@ def download_into_with_progressbar(url, dest):
     download_into(requests, url, f, partial(
       download_process, dest, time.time(), width=w))
 
+def response_from_cache(entry: CacheEntry) -> requests.Response:
+  '''build a Response from a cache entry, which can be streamed too
+
+  >>> r = response_from_cache(CacheEntry('http://example.com/', 200, [], b'a\\nb', 0))
+  >>> list(r.iter_content(1)), list(r.iter_lines())
+  ([b'a', b'\\n', b'b'], [b'a', b'b'])
+  '''
+  r = requests.Response()
+  r.status_code = entry.status
+  r.headers = CaseInsensitiveDict(entry.headers)
+  r._content = entry.body
+  r._content_consumed = True
+  r.raw = io.BytesIO(entry.body)
+  r.url = entry.url
+  r.encoding = get_encoding_from_headers(r.headers)
+  r.reason = ''
+  return r
+
 class RequestsBase:
   _session = None
   __our_session: bool = False
@@ -37,6 +60,8 @@ class RequestsBase:
   lasturl: Optional[str] = None
   auto_referer: bool = False
   baseurl: Optional[str] = None
+  # GET requests go through this cache if set
+  cache: Optional[HttpCache] = None
 
   @property
   def session(self):
@@ -46,10 +71,12 @@ class RequestsBase:
       self._session = s
     return self._session
 
-  def __init__(self, *, baseurl=None, cookiefile=None, session=None):
+  def __init__(self, *, baseurl=None, cookiefile=None, session=None, cache=None):
     if baseurl is not None:
       self.baseurl = baseurl
     self._session = session
+    if cache is not None:
+      self.cache = cache
 
     s = self.session
     if cookiefile:
@@ -89,11 +116,28 @@ class RequestsBase:
       else:
         method = 'get'
 
-    response = self.session.request(method, url, *args, **kwargs)
+    if self.cache is not None and method.lower() == 'get' and not args \
+       and not kwargs.get('stream'):
+      response = self._cached_request(url, **kwargs)
+    else:
+      response = self.session.request(method, url, *args, **kwargs)
     # url may have been changed due to redirection
     self.lasturl = response.url
     return response
 
+  def _cached_request(self, url: str, **kwargs) -> requests.Response:
+    full = requests.Request(
+      'GET', url, params=kwargs.pop('params', None)).prepare().url
+    headers = kwargs.pop('headers')
+
+    def fetch(validators):
+      r = self.session.request(
+        'get', full, headers={**headers, **validators}, **kwargs)
+      return r.url, r.status_code, list(r.headers.items()), r.content
+
+    entry = self.cache.fetch_sync(full, fetch) # type: ignore
+    return response_from_cache(entry)
+
 if __name__ == '__main__':
   from sys import argv, exit
 
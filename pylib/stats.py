@@ -2,6 +2,11 @@
 
 import math
 
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
 NaN = float('NaN')
 
 class Stat:
@@ -10,31 +15,37 @@ class Stat:
   Available properties are:
   - n: number of numbers that have been added
   - sum: sum
-  - avg: average or raise ZeroDivisionError if nothing has been added yet
+  - avg: average or NaN if nothing has been added yet
   - min: minimum or None if nothing has been added yet
   - max: maximum or None if nothing has been added yet
-  - mdev: standard deviation or raise ZeroDivisionError if nothing has been added yet
+  - mdev: standard deviation or NaN if nothing has been added yet
   - sum2: square sum
+
+  The mean and variance are kept with Welford's algorithm, so mdev stays
+  accurate over long runs. Stats from different workers can be combined
+  with merge().
   '''
   n = 0
   sum = 0
   sum2 = 0
+  mean = 0.0
+  m2 = 0.0
   min = max = None
 
   @property
   def avg(self):
-    '''average or 0'''
-    try:
-      return self.sum / self.n
-    except ZeroDivisionError:
+    '''average or NaN'''
+    if self.n:
+      return self.mean
+    else:
       return NaN
 
   @property
   def mdev(self):
-    '''standard deviation or raise ZeroDivisionError if nothing has been added yet'''
-    try:
-      return math.sqrt(self.sum2 / self.n - self.avg ** 2)
-    except ZeroDivisionError:
+    '''standard deviation or NaN'''
+    if self.n:
+      return math.sqrt(self.m2 / self.n)
+    else:
       return NaN
 
   def add(self, x):
@@ -42,6 +53,9 @@ class Stat:
     self.n += 1
     self.sum += x
     self.sum2 += x ** 2
+    delta = x - self.mean
+    self.mean += delta / self.n
+    self.m2 += delta * (x - self.mean)
     if self.min is None:
       self.min = self.max = x
     else:
@@ -50,11 +64,59 @@ class Stat:
       elif x > self.max:
         self.max = x
 
+  def add_many(self, xs):
+    '''add a sequence (or NumPy array) of numbers to stats'''
+    other = Stat()
+    if np is not None and isinstance(xs, np.ndarray):
+      if not xs.size:
+        return
+      xs = xs.astype(float, copy=False).ravel()
+      other.n = xs.size
+      other.sum = float(xs.sum())
+      other.sum2 = float((xs ** 2).sum())
+      other.mean = other.sum / other.n
+      other.m2 = float(((xs - other.mean) ** 2).sum())
+      other.min = float(xs.min())
+      other.max = float(xs.max())
+    else:
+      xs = list(xs)
+      if not xs:
+        return
+      other.n = len(xs)
+      other.sum = math.fsum(xs)
+      other.sum2 = math.fsum(x ** 2 for x in xs)
+      other.mean = other.sum / other.n
+      other.m2 = math.fsum((x - other.mean) ** 2 for x in xs)
+      other.min = min(xs)
+      other.max = max(xs)
+    Stat.merge(self, other)
+
+  def merge(self, other):
+    '''combine stats of other into this one'''
+    if not other.n:
+      return self
+    if not self.n:
+      self.n, self.mean, self.m2 = other.n, other.mean, other.m2
+      self.sum, self.sum2 = other.sum, other.sum2
+      self.min, self.max = other.min, other.max
+      return self
+
+    n = self.n + other.n
+    delta = other.mean - self.mean
+    self.mean += delta * other.n / n
+    self.m2 += other.m2 + delta ** 2 * self.n * other.n / n
+    self.n = n
+    self.sum += other.sum
+    self.sum2 += other.sum2
+    self.min = min(self.min, other.min)
+    self.max = max(self.max, other.max)
+    return self
+
   def __str__(self):
     avg = self.avg
     mdev = self.mdev
-    min = self.min
-    max = self.max
+    min = NaN if self.min is None else self.min
+    max = NaN if self.max is None else self.max
     return 'min/avg/max/mdev = %.3f/%.3f/%.3f/%.3f' % (min, avg, max, mdev)
 
   def __repr__(self):
@@ -63,3 +125,120 @@ class Stat:
       self.__class__.__name__,
       self.__str__(),
     )
+
+class QuantileStat(Stat):
+  '''A Stat that also estimates quantiles, e.g. stat.quantile(0.99)
+
+  Numbers are counted in logarithmic buckets (as in DDSketch), so any
+  quantile is within relative_accuracy of a real value, while memory is
+  bounded by max_buckets. When there are more buckets than that, the
+  ones for the smallest magnitudes are collapsed together. Sketches with
+  the same parameters can be merged.
+  '''
+  def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+    self.relative_accuracy = relative_accuracy
+    self.max_buckets = max_buckets
+    self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self._log_gamma = math.log(self._gamma)
+    self.positive = {}
+    self.negative = {}
+    self.zeros = 0
+
+  def _key(self, x):
+    return math.ceil(math.log(x) / self._log_gamma)
+
+  def _value(self, key):
+    return 2 * self._gamma ** key / (self._gamma + 1)
+
+  def add(self, x):
+    super().add(x)
+    if x > 0:
+      store = self.positive
+    elif x < 0:
+      store = self.negative
+      x = -x
+    else:
+      self.zeros += 1
+      return
+    key = self._key(x)
+    store[key] = store.get(key, 0) + 1
+    if len(store) > self.max_buckets:
+      self._collapse(store)
+
+  def add_many(self, xs):
+    if np is None or not isinstance(xs, np.ndarray):
+      xs = list(xs)
+      for x in xs:
+        self.add(x)
+      return
+
+    super().add_many(xs)
+    xs = xs.astype(float, copy=False).ravel()
+    self.zeros += int((xs == 0).sum())
+    for store, values in ((self.positive, xs[xs > 0]),
+                          (self.negative, -xs[xs < 0])):
+      if not values.size:
+        continue
+      keys = np.ceil(np.log(values) / self._log_gamma).astype(int)
+      for key, c in zip(*np.unique(keys, return_counts=True)):
+        key = int(key)
+        store[key] = store.get(key, 0) + int(c)
+      if len(store) > self.max_buckets:
+        self._collapse(store)
+
+  def _collapse(self, store):
+    keys = sorted(store)
+    n = len(keys) - self.max_buckets + 1
+    into = keys[n]
+    store[into] += sum(store.pop(k) for k in keys[:n])
+
+  def merge(self, other):
+    if self._gamma != other._gamma:
+      raise ValueError('can only merge sketches with the same accuracy')
+    super().merge(other)
+    self.zeros += other.zeros
+    for store, other_store in ((self.positive, other.positive),
+                               (self.negative, other.negative)):
+      for k, c in other_store.items():
+        store[k] = store.get(k, 0) + c
+      if len(store) > self.max_buckets:
+        self._collapse(store)
+    return self
+
+  def quantile(self, q):
+    '''estimated q-quantile (0 <= q <= 1), or NaN if nothing added'''
+    if not self.n:
+      return NaN
+    return min(max(self._quantile(q), self.min), self.max)
+
+  def _quantile(self, q):
+    rank = q * (self.n - 1)
+    seen = 0
+    for k in sorted(self.negative, reverse=True):
+      seen += self.negative[k]
+      if seen > rank:
+        return -self._value(k)
+    seen += self.zeros
+    if seen > rank:
+      return 0.0
+    for k in sorted(self.positive):
+      seen += self.positive[k]
+      if seen > rank:
+        return self._value(k)
+    return self.max
+
+  @property
+  def p50(self):
+    return self.quantile(0.5)
+
+  @property
+  def p90(self):
+    return self.quantile(0.9)
+
+  @property
+  def p99(self):
+    return self.quantile(0.99)
+
+  def __str__(self):
+    return '%s, p50/p90/p99 = %.3f/%.3f/%.3f' % (
+      super().__str__(), self.p50, self.p90, self.p99)
@@ -1,21 +1,162 @@
+import os
 import time
+import mmap
+import fcntl
+import struct
+import asyncio
+import contextlib
+from collections import OrderedDict
 
 class TokenBucket:
   def __init__(self, rate, cap):
     self.rate = rate
     self.cap = cap
     self.tokens = cap
-    self.ts = time.time()
+    self.ts = time.monotonic()
+
+  def _lock(self):
+    return contextlib.nullcontext()
+
+  def _load(self):
+    return self.tokens, self.ts
+
+  def _store(self, tokens, ts):
+    self.tokens = tokens
+    self.ts = ts
+
+  def _take(self, n, allow_debt):
+    '''take n tokens, returning how long to wait until they are available
+
+    Without allow_debt, nothing is taken if there aren't enough tokens.
+    With it, the tokens are reserved anyway, so concurrent callers queue
+    up behind each other.'''
+    with self._lock():
+      tokens, ts = self._load()
+      t = time.monotonic()
+      if ts > t:
+        # the clock went backwards, i.e. the state is from a previous boot
+        tokens = self.cap
+      else:
+        tokens = min(tokens + (t - ts) * self.rate, self.cap)
+      if tokens >= n:
+        wait = 0.0
+        tokens -= n
+      else:
+        wait = (n - tokens) / self.rate
+        if allow_debt:
+          tokens -= n
+      self._store(tokens, t)
+    return wait
+
+  def consume(self, n=1):
+    return self._take(n, False) == 0
 
   def consume_token(self):
-    t = time.time()
-    self.tokens += (t - self.ts) * self.rate
-    self.tokens = min(self.tokens, self.cap)
-    self.ts = t
+    return self.consume(1)
+
+  async def acquire(self, n=1):
+    '''wait until n tokens are available and take them'''
+    wait = self._take(n, True)
+    if wait > 0:
+      await asyncio.sleep(wait)
+
+class SharedTokenBucket(TokenBucket):
+  '''A TokenBucket whose state lives in a small mmap'ed file
+
+  All processes opening the same file share one bucket. The clock is
+  time.monotonic(), which is system-wide on Linux but starts over at
+  boot, so the stored state is only valid within one boot; a bucket
+  found with a timestamp in the future is reset to full.'''
+  _state = struct.Struct('dd')
+
+  def __init__(self, path, rate, cap):
+    self.rate = rate
+    self.cap = cap
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      try:
+        if os.fstat(fd).st_size < self._state.size:
+          os.write(fd, self._state.pack(cap, time.monotonic()))
+      finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+      self._map = mmap.mmap(fd, self._state.size)
+    except BaseException:
+      os.close(fd)
+      raise
+    self._fd = fd
+
+  def close(self):
+    self._map.close()
+    os.close(self._fd)
 
-    if self.tokens < 1:
-      return False
+  @contextlib.contextmanager
+  def _lock(self):
+    fcntl.flock(self._fd, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+  def _load(self):
+    return self._state.unpack_from(self._map)
+
+  def _store(self, tokens, ts):
+    self._state.pack_into(self._map, 0, tokens, ts)
+
+  @property
+  def tokens(self):
+    return self._load()[0]
+
+class KeyedTokenBucket:
+  '''Many token buckets with the same rate and cap, one per key
+
+  Buckets are created on first use, and dropped once they have refilled
+  to cap, as they are then the same as a new one.'''
+  def __init__(self, rate, cap):
+    self.rate = rate
+    self.cap = cap
+    # key -> (tokens, ts), least recently updated first
+    self.buckets = OrderedDict()
+
+  def __len__(self):
+    return len(self.buckets)
+
+  def _evict(self, t):
+    buckets = self.buckets
+    rate = self.rate
+    cap = self.cap
+    while buckets:
+      key = next(iter(buckets))
+      tokens, ts = buckets[key]
+      if tokens + (t - ts) * rate < cap:
+        break
+      del buckets[key]
+
+  def _take(self, key, n, allow_debt):
+    t = time.monotonic()
+    self._evict(t)
+    buckets = self.buckets
+    try:
+      tokens, ts = buckets.pop(key)
+      tokens = min(tokens + (t - ts) * self.rate, self.cap)
+    except KeyError:
+      tokens = self.cap
+
+    if tokens >= n:
+      wait = 0.0
+      tokens -= n
     else:
-      self.tokens -= 1
-      return True
+      wait = (n - tokens) / self.rate
+      if allow_debt:
+        tokens -= n
+    buckets[key] = tokens, t
+    return wait
+
+  def consume(self, key, n=1):
+    return self._take(key, n, False) == 0
 
+  async def acquire(self, key, n=1):
+    wait = self._take(key, n, True)
+    if wait > 0:
+      await asyncio.sleep(wait)
@@ -0,0 +1,41 @@
+/* ZipCrypto (traditional PKWARE encryption) block decryption for gbzip */
+#include<stdint.h>
+#include<stddef.h>
+
+static uint32_t crctable[256];
+static int crctable_ready = 0;
+
+static void make_crctable(void){
+  uint32_t crc;
+  int i, j;
+  for(i=0; i<256; i++){
+    crc = i;
+    for(j=0; j<8; j++)
+      crc = crc & 1 ? (crc >> 1) ^ 0xedb88320 : crc >> 1;
+    crctable[i] = crc;
+  }
+  crctable_ready = 1;
+}
+
+/* decrypt buf of len bytes in place, updating keys[3] */
+void zipcrypto_decrypt(uint32_t *keys, unsigned char *buf, size_t len){
+  uint32_t key0 = keys[0], key1 = keys[1], key2 = keys[2], k;
+  unsigned char c;
+  size_t i;
+
+  if(!crctable_ready)
+    make_crctable();
+
+  for(i=0; i<len; i++){
+    k = (key2 | 2) & 0xffff;
+    c = buf[i] ^ (unsigned char)((k * (k ^ 1)) >> 8);
+    buf[i] = c;
+    key0 = (key0 >> 8) ^ crctable[(key0 ^ c) & 0xff];
+    key1 = (key1 + (key0 & 0xff)) * 134775813 + 1;
+    key2 = (key2 >> 8) ^ crctable[(key2 ^ (key1 >> 24)) & 0xff];
+  }
+
+  keys[0] = key0;
+  keys[1] = key1;
+  keys[2] = key2;
+}